@@ -22,6 +22,14 @@ if [ -n "${PANDORA_SERVER}" ]; then
   PANDORA_ARGS="${PANDORA_ARGS} -s ${PANDORA_SERVER}"
 fi
 
+if [ -n "${PANDORA_SERVER_ENGINE}" ]; then
+  PANDORA_ARGS="${PANDORA_ARGS} --server_engine ${PANDORA_SERVER_ENGINE}"
+fi
+
+if [ -n "${PANDORA_WORKERS}" ]; then
+  PANDORA_ARGS="${PANDORA_ARGS} --workers ${PANDORA_WORKERS}"
+fi
+
 if [ -n "${PANDORA_API}" ]; then
   PANDORA_ARGS="${PANDORA_ARGS} -a"
 fi
@@ -37,6 +37,7 @@ setup(
     extras_require={
         'api': requirements_api,
         'cloud': ['pandora-cloud~=0.1.0'],
+        'asgi': ['uvicorn~=0.22.0'],
     },
     entry_points={
         'console_scripts': [
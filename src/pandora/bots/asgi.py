@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from ..openai.stream import engine as stream_engine
+
+
+class WsgiBridge:
+    """ 以 ASGI 方式运行 Flask 应用，路由与 waitress 模式完全相同。
+    1. 请求本身（包括与上游的握手）在线程池中执行，线程池大小由 --threads 指定。
+    2. 响应体来自上游流时，只在流中有数据到达后才提交到线程池读取，等待上游期间不占用线程。
+       读取时只取出不会阻塞的部分，一个字节块中的多个事件立即发出，只收到半行时不占用线程等待。
+    3. 其他响应在线程池中逐块读出并发送，不在内存中拼接整个响应体。
+    4. 发送流的过程中同时等待客户端断开，断开后立即关闭响应，上游请求随之取消。
+    """
+
+    def __init__(self, app, threads=8):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max(1, threads), thread_name_prefix='pandora-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if 'http' != scope['type']:
+            return
+
+        loop = asyncio.get_event_loop()
+        environ = self.__build_environ(scope, await self.__read_body(receive))
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]
+
+        iterable, channels = await loop.run_in_executor(self.executor, stream_engine.capture, self.app, environ,
+                                                        start_response)
+
+        try:
+            await send({'type': 'http.response.start', 'status': response['status'],
+                        'headers': response['headers']})
+
+            if channels:
+                disconnect = asyncio.ensure_future(self.__wait_disconnect(receive))
+                try:
+                    await self.__send_stream(loop, iterable, channels, send, disconnect)
+                finally:
+                    disconnect.cancel()
+            else:
+                await self.__send_body(loop, iterable, send)
+        finally:
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, iterable.close)
+
+    async def __send_body(self, loop, iterable, send):
+        iterator = iter(iterable)
+
+        while True:
+            chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+            if chunk is None:
+                break
+
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def __send_stream(self, loop, iterable, channels, send, disconnect):
+        iterator = iter(iterable)
+
+        while True:
+            await self.__wait_ready(loop, channels, disconnect)
+            if disconnect.done():
+                return
+
+            chunks, finished = await loop.run_in_executor(self.executor, self.__read_ready, iterator, channels)
+            if chunks:
+                await send({'type': 'http.response.body', 'body': b''.join(chunks), 'more_body': True})
+
+            if finished:
+                break
+
+        await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    def __read_ready(iterator, channels):
+        chunks = []
+
+        while all(channel.ready() for channel in channels if not channel.closed):
+            chunk = next(iterator, None)
+            if chunk is None:
+                return chunks, True
+
+            chunks.append(chunk)
+
+        return chunks, False
+
+    @staticmethod
+    async def __wait_ready(loop, channels, disconnect):
+        futures = [channel.wait_ready(loop) for channel in channels if not channel.closed]
+        if not futures:
+            return
+
+        _, pending = await asyncio.wait(futures + [disconnect], return_when=asyncio.FIRST_COMPLETED)
+
+        for future in pending:
+            if future is not disconnect:
+                future.cancel()
+
+    @staticmethod
+    async def __wait_disconnect(receive):
+        while 'http.disconnect' != (await receive())['type']:
+            pass
+
+    @staticmethod
+    async def __read_body(receive):
+        body = b''
+
+        while True:
+            message = await receive()
+            if 'http.request' != message['type']:
+                break
+
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                break
+
+        return body
+
+    @staticmethod
+    def __build_environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin1'),
+            'QUERY_STRING': scope['query_string'].decode('ascii'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope['http_version']),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+            environ['REMOTE_PORT'] = str(scope['client'][1])
+
+        for name, value in scope['headers']:
+            name = name.decode('latin1')
+            value = value.decode('latin1')
+
+            if 'content-type' == name:
+                key = 'CONTENT_TYPE'
+            elif 'content-length' == name:
+                key = 'CONTENT_LENGTH'
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+
+            if key in environ:
+                value = environ[key] + ('; ' if 'HTTP_COOKIE' == key else ',') + value
+
+            environ[key] = value
+
+        return environ
+
+
+def serve(app, host, port, threads=8, sockets=None):
+    import uvicorn
+
+    config = uvicorn.Config(WsgiBridge(app, threads), host=host, port=port, lifespan='off', log_level='warning',
+                            access_log=False)
+    uvicorn.Server(config).run(sockets=sockets)
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 #br 这个没看懂从哪过来的，应该也是launcher.py跳转
 import logging
+import os
+import signal
+import socket
+import sys
 from datetime import timedelta
 from os.path import join, abspath, dirname
 
@@ -14,11 +18,19 @@ from werkzeug.serving import WSGIRequestHandler
 from .. import __version__
 from ..exts.hooks import hook_logging
 from ..openai.api import API
+from ..openai.cache import cache as response_cache, single_flight
+from ..openai.limiter import limiter as rate_limiter
+from ..openai.pool import pool as client_pool
+from ..openai.result import Result
+from ..openai.stream import engine as stream_engine, EventStream
 
 
 class ChatBot:
     __default_ip = '127.0.0.1'
     __default_port = 8008
+    __skip_headers = {'connection', 'keep-alive', 'transfer-encoding', 'content-length', 'content-encoding', 'te',
+                      'trailer', 'upgrade', 'proxy-authenticate', 'set-cookie', 'server', 'date'}
+    __copy_header_keys = ('Retry-After', 'X-Queue-Wait')
 
     def __init__(self, chatgpt, debug=False, sentry=False):
         self.chatgpt = chatgpt
@@ -29,7 +41,7 @@ class ChatBot:
         hook_logging(level=self.log_level, format='[%(asctime)s] %(levelname)s in %(module)s: %(message)s')
         self.logger = logging.getLogger('waitress')
 
-    def run(self, bind_str, threads=8):
+    def run(self, bind_str, threads=8, server_engine='waitress', workers=1):
         host, port = self.__parse_bind(bind_str)
 
         resource_path = abspath(join(dirname(__file__), '..', 'flask'))
@@ -37,6 +49,7 @@ class ChatBot:
                     static_folder=join(resource_path, 'static'),
                     template_folder=join(resource_path, 'templates'))
         app.wsgi_app = ProxyFix(app.wsgi_app, x_port=1)
+        app.before_request(self.__before_request)
         app.after_request(self.__after_request)
 
         CORS(app, resources={r'/api/*': {'supports_credentials': True, 'expose_headers': [
@@ -64,6 +77,8 @@ class ChatBot:
         app.route('/api/conversation/regenerate', methods=['POST'])(self.regenerate)
         app.route('/api/conversation/goon', methods=['POST'])(self.goon)
 
+        app.route('/api/stats')(self.stats)
+
         app.route('/api/auth/session')(self.session)
         app.route('/api/accounts/check')(self.check)
         app.route('/_next/data/olf4sv64FWIcQ_zCGl90t/chat.json')(self.chat_info)
@@ -75,8 +90,66 @@ class ChatBot:
         if not self.debug:
             self.logger.warning('Serving on http://{}:{}'.format(host, port))
 
+        if workers > 1:
+            return self.__serve_workers(app, host, port, threads, server_engine, workers)
+
+        self.__serve(app, host, port, threads, server_engine)
+
+    @staticmethod
+    def __serve(app, host, port, threads, server_engine, sockets=None):
+        if 'asgi' == server_engine:
+            from .asgi import serve as serve_asgi
+
+            return serve_asgi(app, host=host, port=port, threads=threads, sockets=sockets)
+
         WSGIRequestHandler.protocol_version = 'HTTP/1.1'
-        serve(app, host=host, port=port, ident=None, threads=threads)
+
+        # 保持读取客户端连接，以便在生成过程中发现客户端已断开
+        if sockets:
+            serve(app, sockets=sockets, ident=None, threads=threads, channel_request_lookahead=1)
+        else:
+            serve(app, host=host, port=port, ident=None, threads=threads, channel_request_lookahead=1)
+
+    def __serve_workers(self, app, host, port, threads, server_engine, workers):
+        """ 预先 fork 出多个工作进程，共同监听父进程创建的 socket，父进程只负责等待和结束子进程。 """
+        family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(1024)
+
+        pids = []
+        for _ in range(workers):
+            pid = os.fork()
+            if 0 == pid:
+                try:
+                    self.__serve(app, host, port, threads, server_engine, [sock])
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os._exit(0)
+
+            pids.append(pid)
+
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+        try:
+            for pid in pids:
+                os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+            sock.close()
+
+    @staticmethod
+    def __before_request():
+        stream_engine.watch(request.environ.get('waitress.client_disconnected'))
 
     @staticmethod
     def __after_request(resp):
@@ -194,14 +267,35 @@ class ChatBot:
 
         return jsonify(ret)
 
+    def stats(self):
+        ret = {
+            'stream': stream_engine.stats(),
+            'pool': client_pool.stats(),
+            'cache': response_cache.stats(),
+            'single_flight': single_flight.stats(),
+            'limiter': rate_limiter.stats(),
+        }
+
+        scheduler = getattr(self.chatgpt, 'scheduler', None)
+        if scheduler:
+            ret['scheduler'] = scheduler.stats()
+
+        resident_pool = getattr(self.chatgpt, 'resident_pool', None)
+        if resident_pool:
+            ret['resident'] = resident_pool.stats()
+
+        return jsonify(ret)
+
     def list_models(self):
         return self.__proxy_result(self.chatgpt.list_models(True, self.__get_token_key()))
 
     def list_conversations(self):
         offset = request.args.get('offset', '0')
         limit = request.args.get('limit', '20')
+        cursor = request.args.get('cursor')
 
-        return self.__proxy_result(self.chatgpt.list_conversations(offset, limit, True, self.__get_token_key()))
+        return self.__proxy_result(
+            self.chatgpt.list_conversations(offset, limit, True, self.__get_token_key(), cursor))
 
     def get_conversation(self, conversation_id):
         return self.__proxy_result(self.chatgpt.get_conversation(conversation_id, True, self.__get_token_key()))
@@ -234,10 +328,11 @@ class ChatBot:
         parent_message_id = payload['parent_message_id']
         conversation_id = payload.get('conversation_id')
         stream = payload.get('stream', True)
+        delta = self.__get_delta(payload, stream)
 
         return self.__process_stream(
             *self.chatgpt.talk(prompt, model, message_id, parent_message_id, conversation_id, stream,
-                               self.__get_token_key()), stream)
+                               self.__get_token_key(), delta), stream, delta)
 
     def goon(self):
         payload = request.json
@@ -245,9 +340,11 @@ class ChatBot:
         parent_message_id = payload['parent_message_id']
         conversation_id = payload.get('conversation_id')
         stream = payload.get('stream', True)
+        delta = self.__get_delta(payload, stream)
 
         return self.__process_stream(
-            *self.chatgpt.goon(model, parent_message_id, conversation_id, stream, self.__get_token_key()), stream)
+            *self.chatgpt.goon(model, parent_message_id, conversation_id, stream, self.__get_token_key(), delta),
+            stream, delta)
 
     def regenerate(self):
         payload = request.json
@@ -261,25 +358,57 @@ class ChatBot:
         message_id = payload['message_id']
         parent_message_id = payload['parent_message_id']
         stream = payload.get('stream', True)
+        delta = self.__get_delta(payload, stream)
 
         return self.__process_stream(
             *self.chatgpt.regenerate_reply(prompt, model, conversation_id, message_id, parent_message_id, stream,
-                                           self.__get_token_key()), stream)
+                                           self.__get_token_key(), delta), stream, delta)
 
     @staticmethod
-    def __process_stream(status, headers, generator, stream):
+    def __get_delta(payload, stream):
+        return bool(stream and payload.get('delta', False))
+
+    def __process_stream(self, status, headers, generator, stream, delta=False):
+        if stream and isinstance(generator, EventStream):
+            tap = self.__log_event if self.debug else None
+            resp = Response(generator.chunks(tap), headers=self.__proxy_headers(headers), status=status)
+            resp.headers['X-Stream-Mode'] = 'full'
+
+            return resp
+
         if stream:
-            return Response(API.wrap_stream_out(generator, status), mimetype=headers['Content-Type'], status=status)
+            resp = Response(API.wrap_stream_out(generator, status), mimetype=headers['Content-Type'], status=status)
+            resp.headers['X-Stream-Mode'] = 'delta' if delta else 'full'
+
+            return self.__copy_headers(resp, headers)
 
         last_json = None
         for json in generator:
             last_json = json
 
-        return make_response(last_json, status)
+        return self.__copy_headers(make_response(last_json, status), headers)
+
+    def __copy_headers(self, resp, headers):
+        for key in self.__copy_header_keys:
+            value = headers.get(key)
+            if value:
+                resp.headers[key] = value
+
+        return resp
+
+    def __proxy_headers(self, headers):
+        return [(k, v) for k, v in headers.multi_items()
+                if k not in self.__skip_headers and not k.startswith('access-control-')]
+
+    def __log_event(self, event):
+        self.logger.debug(event)
 
     @staticmethod
     def __proxy_result(remote_resp):
-        resp = make_response(remote_resp.text)
+        if isinstance(remote_resp, Result):
+            return Response(remote_resp.get_body(), remote_resp.status_code, content_type=remote_resp.content_type)
+
+        resp = make_response(remote_resp.content)
         resp.content_type = remote_resp.headers['Content-Type']
         resp.status_code = remote_resp.status_code
 
@@ -176,6 +176,21 @@ def main():
         type=int,
         default=8,
     )
+    parser.add_argument(
+        '--server_engine',
+        help='Define the server engine: waitress or asgi, default: waitress',
+        required=False,
+        type=str,
+        choices=['waitress', 'asgi'],
+        default='waitress',
+    )
+    parser.add_argument(
+        '--workers',
+        help='Define the number of server processes, default: 1',
+        required=False,
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         '-a',
         '--api',
@@ -211,6 +226,23 @@ def main():
         except (ImportError, ModuleNotFoundError):
             Console.error_bh('### You need `pip install Pandora-ChatGPT[api]` to support API mode.')
             return
+
+    if args.server and args.workers > 1:
+        if not hasattr(os, 'fork'):
+            Console.error_bh('### `--workers` is not supported on Windows.')
+            return
+
+        if args.api and 'memory' == getenv('API_STORAGE'):
+            Console.error_bh('### `--workers` can not be used with `API_STORAGE=memory`.')
+            return
+
+    if args.server and 'asgi' == args.server_engine:
+        try:
+            import uvicorn
+        except (ImportError, ModuleNotFoundError):
+            Console.error_bh('### You need `pip install Pandora-ChatGPT[asgi]` to support ASGI server engine.')
+            return
+
     #br 这是后面的函数第一行，如检查token是否过期
     access_tokens = parse_access_tokens(args.tokens_file, args.api) if args.tokens_file else None
 
@@ -236,12 +268,13 @@ def main():
     if args.api:
         from .turbo.chat import TurboGPT
 
-        chatgpt = TurboGPT(access_tokens, args.proxy)
+        chatgpt = TurboGPT(access_tokens, args.proxy, bool(args.server) and args.workers > 1)
     else:
         chatgpt = ChatGPT(access_tokens, args.proxy)
 
     if args.server:
-        return ChatBotServer(chatgpt, args.verbose, args.sentry).run(args.server, args.threads)
+        return ChatBotServer(chatgpt, args.verbose, args.sentry).run(args.server, args.threads, args.server_engine,
+                                                                       args.workers)
 
     ChatBotLegacy(chatgpt).run()
 
@@ -1,12 +1,55 @@
 # -*- coding: utf-8 -*-
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import os
+from contextlib import contextmanager
+from os import getenv
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 from ..exts.config import DATABASE_URI
 
-engine = create_engine(DATABASE_URI, echo=False)
+
+def __engine_kwargs():
+    kwargs = {
+        'pool_pre_ping': True,
+    }
+
+    if 'sqlite:' != DATABASE_URI[0:7]:
+        kwargs['pool_size'] = int(getenv('DATABASE_POOL_SIZE', 5))
+        kwargs['max_overflow'] = int(getenv('DATABASE_MAX_OVERFLOW', 10))
+        kwargs['pool_recycle'] = int(getenv('DATABASE_POOL_RECYCLE', 3600))
+
+    return kwargs
+
+
+def __set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout={}'.format(int(getenv('DATABASE_BUSY_TIMEOUT', 5000))))
+    cursor.close()
+
+
+engine = create_engine(DATABASE_URI, echo=False, **__engine_kwargs())
+
+if 'sqlite:' == DATABASE_URI[0:7]:
+    event.listen(engine, 'connect', __set_sqlite_pragma)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
 
 Session = sessionmaker(bind=engine)
 
-session = Session()
+session = scoped_session(Session)
+
+
+@contextmanager
+def session_scope():
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.remove()
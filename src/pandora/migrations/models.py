@@ -2,14 +2,32 @@
 
 from datetime import datetime as dt
 
-from sqlalchemy import func, Column, Text, Integer
+from sqlalchemy import func, and_, or_, Column, Text, Double
 from sqlalchemy.orm import DeclarativeBase
 
 from ..migrations.database import session
 
 
 class Base(DeclarativeBase):
-    pass
+    @staticmethod
+    def merge_all(items):
+        try:
+            for item in items:
+                session.merge(item)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    @classmethod
+    def paginate(cls, query, offset, limit, cursor=None):
+        if cursor:
+            create_time, conversation_id = cursor
+            query = query.filter(or_(cls.create_time < create_time,
+                                     and_(cls.create_time == create_time, cls.conversation_id < conversation_id)))
+            offset = 0
+
+        return query.order_by(cls.create_time.desc(), cls.conversation_id.desc()).limit(limit).offset(offset).all()
 
 
 class ConversationOfficial(Base):
@@ -17,13 +35,19 @@ class ConversationOfficial(Base):
 
     conversation_id = Column(Text, primary_key=True, autoincrement=False)
     title = Column(Text, nullable=False)
-    create_time = Column(Integer, nullable=False)
+    create_time = Column(Double, nullable=False)
+
+    @staticmethod
+    def count():
+        return session.query(func.count(ConversationOfficial.conversation_id)).scalar()
+
+    @staticmethod
+    def get_page(offset, limit, cursor=None):
+        return ConversationOfficial.paginate(session.query(ConversationOfficial), offset, limit, cursor)
 
     @staticmethod
-    def get_list(offset, limit):
-        total = session.query(func.count(ConversationOfficial.conversation_id)).scalar()
-        return total, session.query(ConversationOfficial).order_by(ConversationOfficial.create_time.desc()).limit(
-            limit).offset(offset).all()
+    def get_list(offset, limit, cursor=None):
+        return ConversationOfficial.count(), ConversationOfficial.get_page(offset, limit, cursor)
 
     @staticmethod
     def get(conversation_id):
@@ -83,14 +107,36 @@ class ConversationInfo(Base):
 
     conversation_id = Column(Text, primary_key=True, autoincrement=False)
     title = Column(Text, nullable=False)
-    create_time = Column(Integer, nullable=False)
+    create_time = Column(Double, nullable=False)
     current_node = Column(Text, nullable=True)
+    token_key = Column(Text, nullable=True)
+
+    @staticmethod
+    def __query(token_key=None):
+        query = session.query(ConversationInfo)
+        if token_key is not None:
+            query = query.filter(ConversationInfo.token_key == token_key)
+
+        return query
+
+    @staticmethod
+    def count(token_key=None):
+        return ConversationInfo.__query(token_key).with_entities(func.count(ConversationInfo.conversation_id)).scalar()
 
     @staticmethod
-    def get_list(offset, limit):
-        total = session.query(func.count(ConversationInfo.conversation_id)).scalar()
-        return total, session.query(ConversationInfo).order_by(ConversationInfo.create_time.desc()).limit(
-            limit).offset(offset).all()
+    def get_page(offset, limit, token_key=None, cursor=None):
+        return ConversationInfo.paginate(ConversationInfo.__query(token_key), offset, limit, cursor)
+
+    @staticmethod
+    def count_newer(create_time, conversation_id, token_key=None):
+        return ConversationInfo.__query(token_key).filter(
+            or_(ConversationInfo.create_time > create_time,
+                and_(ConversationInfo.create_time == create_time, ConversationInfo.conversation_id > conversation_id))
+        ).with_entities(func.count(ConversationInfo.conversation_id)).scalar()
+
+    @staticmethod
+    def get_list(offset, limit, token_key=None, cursor=None):
+        return ConversationInfo.count(token_key), ConversationInfo.get_page(offset, limit, token_key, cursor)
 
     @staticmethod
     def get(conversation_id):
@@ -112,6 +158,15 @@ class ConversationInfo(Base):
         session.query(ConversationInfo).delete()
         session.commit()
 
+    @staticmethod
+    def clear_by_token_key(token_key):
+        conversation_ids = session.query(ConversationInfo.conversation_id).filter(
+            ConversationInfo.token_key == token_key)
+        session.query(PromptInfo).filter(PromptInfo.conversation_id.in_(conversation_ids)).delete(
+            synchronize_session=False)
+        session.query(ConversationInfo).filter(ConversationInfo.token_key == token_key).delete()
+        session.commit()
+
 
 class PromptInfo(Base):
     __tablename__ = 'prompt_info'
@@ -122,12 +177,17 @@ class PromptInfo(Base):
     parent_id = Column(Text, nullable=True)
     role = Column(Text, nullable=True)
     content = Column(Text, nullable=True)
-    create_time = Column(Integer, nullable=False)
+    create_time = Column(Double, nullable=False)
 
     @staticmethod
     def list_by_conversation_id(conversation_id):
         return session.query(PromptInfo).filter(PromptInfo.conversation_id == conversation_id).all()
 
+    @staticmethod
+    def delete_by_conversation_id(conversation_id):
+        session.query(PromptInfo).filter(PromptInfo.conversation_id == conversation_id).delete()
+        session.commit()
+
     def new(self):
         session.add(self)
         session.commit()
@@ -0,0 +1,5 @@
+-- Conversation owner for api mode
+-- depends: 20230308_01_7ctOr
+
+alter table conversation_info
+    add token_key varchar(128);
@@ -0,0 +1,11 @@
+-- Indexes for conversation list
+-- depends: 20230611_01_Hx3Qa
+
+create index conversation_official_create_time_index
+    on conversation_official (create_time, conversation_id);
+
+create index conversation_info_token_key_create_time_index
+    on conversation_info (token_key, create_time, conversation_id);
+
+create index prompt_info_parent_id_index
+    on prompt_info (parent_id);
@@ -0,0 +1,29 @@
+"""
+Store create_time as double
+"""
+
+from yoyo import step
+
+__depends__ = {'20230613_01_Kp2Wd'}
+
+TABLES = ('conversation_official', 'conversation_info', 'prompt_info')
+
+
+def apply_step(conn):
+    # sqlite 的 integer 列会原样保存小数，只有 mysql、postgresql 需要修改列类型
+    module = type(conn).__module__
+    if module.startswith('pymysql') or module.startswith('MySQLdb'):
+        sql = 'alter table {} modify create_time double not null'
+    elif module.startswith('psycopg'):
+        sql = 'alter table {} alter column create_time type double precision'
+    else:
+        return
+
+    cursor = conn.cursor()
+    for table in TABLES:
+        cursor.execute(sql.format(table))
+
+
+steps = [
+    step(apply_step),
+]
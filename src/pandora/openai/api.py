@@ -1,104 +1,195 @@
 # -*- coding: utf-8 -*-
 #br 这个是从server.py 跳过来的
 import asyncio
-import json
-import queue as block_queue
-import threading
+import math
+import random
+import time
 from os import getenv
 
 import httpx
 import requests
 from certifi import where
-
+from requests.structures import CaseInsensitiveDict
+
+from . import codec
+from .cache import cache as response_cache, single_flight
+from .limiter import limiter as rate_limiter, RateLimitTimeout
+from .pool import pool as client_pool
+from .result import Result, ReleasingIterator
+from .stream import engine as stream_engine, EventStream
+from .token import gpt_num_tokens
 from .. import __version__
 
 
 class API:
+    """ 上游请求的公共部分。
+    1. 连接超时、首字节超时（发出请求到收到响应头）、流中两次数据之间的空闲超时分别设置。
+    2. 幂等的 GET 请求在连接失败、超时或 502/503/504 时按带随机抖动的指数退避重试。
+    3. 开启 hedge 的流式请求在 hedge_delay 秒内没有收到响应头时再发出一次相同的请求，先返回的被采用，另一个被取消。
+    """
+
+    RETRY_STATUS = (502, 503, 504)
+
     def __init__(self, proxy, ca_bundle):
         self.proxy = proxy
         self.ca_bundle = ca_bundle
+        self.connect_timeout = float(getenv('PANDORA_CONNECT_TIMEOUT', 10))
+        self.first_byte_timeout = float(getenv('PANDORA_FIRST_BYTE_TIMEOUT', 120))
+        self.idle_timeout = float(getenv('PANDORA_IDLE_TIMEOUT', 600))
+        self.pool_timeout = float(getenv('PANDORA_POOL_TIMEOUT', 5))
+        self.retries = int(getenv('PANDORA_RETRIES', 2))
+        self.retry_backoff = float(getenv('PANDORA_RETRY_BACKOFF', 0.5))
+        self.hedge_delay = float(getenv('PANDORA_HEDGE_DELAY', 0))
+
+    def _retry(self, func):
+        attempt = 0
+        while True:
+            try:
+                resp = func()
+                if resp.status_code not in self.RETRY_STATUS or attempt >= self.retries:
+                    return resp
+                resp.close()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+
+            time.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+            attempt += 1
+            client_pool.record('retries')
 
     @staticmethod
     def wrap_stream_out(generator, status):
-        if status != 200:
-            for line in generator:
-                yield json.dumps(line)
-
-            return
+        try:
+            if status != 200:
+                for line in generator:
+                    yield codec.dumps(line)
 
-        for line in generator:
-            yield b'data: ' + json.dumps(line).encode('utf-8') + b'\n\n'
+                return
 
-        yield b'data: [DONE]\n\n'
+            for line in generator:
+                yield codec.frame(line)
 
-    async def __process_sse(self, resp):
-        yield resp.status_code
-        yield resp.headers
+            yield codec.DONE_FRAME
+        finally:
+            if hasattr(generator, 'close'):
+                generator.close()
 
-        if resp.status_code != 200:
-            yield await self.__process_sse_except(resp)
-            return
+    @staticmethod
+    def _out_rate_limited(data, retry_after):
+        headers = CaseInsensitiveDict({
+            'Content-Type': 'application/json',
+            'Retry-After': str(int(math.ceil(retry_after))),
+        })
 
-        async for utf8_line in resp.aiter_lines():
-            if 'data: [DONE]' == utf8_line[0:12]:
-                break
+        def __generator():
+            yield data
 
-            if 'data: {' == utf8_line[0:7]:
-                yield json.loads(utf8_line[6:])
+        return 429, headers, __generator()
 
     @staticmethod
-    async def __process_sse_except(resp):
-        result = b''
-        async for line in resp.aiter_bytes():
-            result += line
+    def _after_rate_limit(key, status, headers, waited):
+        if 429 == status:
+            rate_limiter.backoff(key, headers.get('Retry-After'))
 
-        return json.loads(result.decode('utf-8'))
+        if rate_limiter.enabled:
+            headers['X-Queue-Wait'] = '{:.3f}'.format(waited)
 
     @staticmethod
-    def __generate_wrap(queue, thread, event):
-        while True:
-            #br 可能是对gpt的回答进行编码处理
-            try:
-                item = queue.get()
-                if item is None:
-                    break
+    async def __process_sse(resp):
+        yield resp.status_code
+        yield resp.headers
 
-                yield item
-            except BaseException as e:
-                event.set()
-                thread.join()
+        # 原样读出整个响应体，不在事件循环中解析，读完后连接可以回到连接池
+        async for chunk in resp.aiter_bytes():
+            yield chunk
 
-                if isinstance(e, GeneratorExit):
-                    raise e
+    async def _do_request_sse(self, url, headers, data, hedge=False):
+        client = client_pool.get_async_client(self.proxy, self.ca_bundle)
+        resp = await self.__open_stream(client, url, headers, data, hedge)
+
+        try:
+            async for line in self.__process_sse(resp):
+                yield line
+        finally:
+            await resp.aclose()
 
-    async def _do_request_sse(self, url, headers, data, queue, event):
-        async with httpx.AsyncClient(verify=self.ca_bundle, proxies=self.proxy) as client:
-            async with client.stream('POST', url, json=data, headers=headers, timeout=600) as resp:
-                async for line in self.__process_sse(resp):
-                    queue.put(line)
+    async def __open_stream(self, client, url, headers, data, hedge):
+        timeout = httpx.Timeout(self.idle_timeout, connect=self.connect_timeout, pool=self.pool_timeout)
 
-                    if event.is_set():
-                        await client.aclose()
-                        break
+        def __send():
+            request = client.build_request('POST', url, json=data, headers=headers, timeout=timeout,
+                                           extensions=client_pool.trace())
+            return asyncio.ensure_future(client.send(request, stream=True))
 
-                queue.put(None)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.first_byte_timeout
+        tasks = [__send()]
+        pending = list(tasks)
 
-    def _request_sse(self, url, headers, data):
+        try:
+            if hedge and 0 < self.hedge_delay < self.first_byte_timeout:
+                done, _ = await asyncio.wait(pending, timeout=self.hedge_delay)
+                if not done:
+                    tasks.append(__send())
+                    pending.append(tasks[-1])
+                    client_pool.record('hedged')
+
+            error = None
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=deadline - loop.time(),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise httpx.ReadTimeout('No response from upstream in {}s'.format(self.first_byte_timeout))
+
+                for task in tasks:
+                    if task not in done:
+                        continue
+
+                    pending.remove(task)
+                    if task.exception():
+                        error = task.exception()
+                        continue
+
+                    for other in done:
+                        if other is not task and not other.exception():
+                            await other.result().aclose()
+
+                    if task is not tasks[0]:
+                        client_pool.record('hedge_wins')
+
+                    return task.result()
+
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _request_sse(self, url, headers, data, hedge=False):
         #br 这地方是队列获取，可能是流式输出的开始
-        queue, e = block_queue.Queue(), threading.Event()
-        t = threading.Thread(target=asyncio.run, args=(self._do_request_sse(url, headers, data, queue, e),))
-        t.start()
+        channel = stream_engine.open(self._do_request_sse(url, headers, data, hedge))
 
-        return queue.get(), queue.get(), self.__generate_wrap(queue, t, e)
+        try:
+            status = channel.get()
+            return status, channel.get(), EventStream(channel, status)
+        except BaseException:
+            channel.close()
+            raise
 
 
 class ChatGPT(API):
+    """ 免费模式，GET 请求以流式读取上游响应，按块原样转发字节。
+    1. 非 200 的响应和 Content-Length 不超过 cache_max_body 的响应一次读完，可以缓存，也由并发的相同请求共用。
+    2. 其他响应边读边转发，读完时总大小不超过 cache_max_body 的才缓存；并发的相同请求各自向上游请求，不共用。
+    """
+
+    CHUNK_SIZE = 65536
+
     def __init__(self, access_tokens: dict, proxy=None):
         #br API post通讯
         self.access_tokens = access_tokens
         self.access_token_key_list = list(access_tokens)
         self.default_token_key = self.access_token_key_list[0]
-        self.session = requests.Session()
+        self.session = client_pool.mount(requests.Session())
         self.req_kwargs = {
             'proxies': {
                 'http': proxy,
@@ -113,8 +204,12 @@ class ChatGPT(API):
                           'Pandora/{} Safari/537.36'.format(__version__)
 
         self.api_prefix = getenv('CHATGPT_API_PREFIX', 'https://ai.fakeopen.com')
+        self.cache_ttl = float(getenv('PANDORA_CACHE_TTL', 60))
+        self.models_cache_ttl = float(getenv('PANDORA_MODELS_CACHE_TTL', 600))
+        self.cache_max_body = int(getenv('PANDORA_CACHE_MAX_BODY', 1024)) * 1024
 
         super().__init__(proxy, self.req_kwargs['verify'])
+        self.req_kwargs['timeout'] = (self.connect_timeout, self.req_kwargs['timeout'])
 
     def __get_headers(self, token_key=None):
         return {
@@ -129,9 +224,79 @@ class ChatGPT(API):
     def list_token_keys(self):
         return self.access_token_key_list
 
+    def __cached_get(self, url, token, key, ttl):
+        token = token or self.default_token_key
+        key = (token,) + key
+
+        resp = response_cache.get(key)
+        if resp is not None:
+            return resp
+
+        fetched = []
+
+        def __fetch():
+            fetched.append(True)
+            version = response_cache.version(token)
+            remote_resp = self._retry(
+                lambda: self.session.get(url=url, headers=self.__get_headers(token), stream=True, **self.req_kwargs))
+
+            length = remote_resp.headers.get('Content-Length', '')
+            if 200 != remote_resp.status_code or length.isdigit() and int(length) <= self.cache_max_body:
+                result = self.__read_result(remote_resp)
+                if 200 == result.status_code:
+                    response_cache.set(key, result, ttl, version)
+
+                return result, True
+
+            client_pool.record('relayed')
+            chunks = ReleasingIterator(self.__relay(remote_resp, key, ttl, version), remote_resp.close)
+
+            return self.__make_result(remote_resp, chunks=chunks), False
+
+        result, shareable = single_flight.do((token, 'GET', url), __fetch)
+        if shareable or fetched:
+            return result
+
+        return __fetch()[0]
+
+    @staticmethod
+    def __make_result(remote_resp, content=None, chunks=None):
+        return Result(status=remote_resp.status_code, content=content, chunks=chunks,
+                      content_type=remote_resp.headers.get('Content-Type', 'application/json'))
+
+    def __read_result(self, remote_resp):
+        try:
+            return self.__make_result(remote_resp, content=remote_resp.content)
+        finally:
+            remote_resp.close()
+
+    def __relay(self, remote_resp, key, ttl, version):
+        chunks = []
+        size = 0
+
+        for chunk in remote_resp.iter_content(self.CHUNK_SIZE):
+            size += len(chunk)
+            if chunks is not None:
+                if size <= self.cache_max_body:
+                    chunks.append(chunk)
+                else:
+                    chunks = None
+
+            yield chunk
+
+        if chunks is not None:
+            response_cache.set(key, self.__make_result(remote_resp, content=b''.join(chunks)), ttl, version)
+
+    def __invalidate(self, token, conversation_id=None, all_conversations=False):
+        token = token or self.default_token_key
+
+        response_cache.invalidate(token, 'conversations')
+        if conversation_id or all_conversations:
+            response_cache.invalidate(token, 'conversation', conversation_id)
+
     def list_models(self, raw=False, token=None):
         url = '{}/api/models'.format(self.api_prefix)
-        resp = self.session.get(url=url, headers=self.__get_headers(token), **self.req_kwargs)
+        resp = self.__cached_get(url, token, ('models', None), self.models_cache_ttl)
 
         if raw:
             return resp
@@ -145,10 +310,10 @@ class ChatGPT(API):
 
         return result['models']
 
-    def list_conversations(self, offset, limit, raw=False, token=None):
-        #br 列出对话ID
+    def list_conversations(self, offset, limit, raw=False, token=None, cursor=None):
+        #br 列出对话ID，官方接口只支持 offset 分页，cursor 参数会被忽略
         url = '{}/api/conversations?offset={}&limit={}'.format(self.api_prefix, offset, limit)
-        resp = self.session.get(url=url, headers=self.__get_headers(token), **self.req_kwargs)
+        resp = self.__cached_get(url, token, ('conversations', (str(offset), str(limit))), self.cache_ttl)
 
         if raw:
             return resp
@@ -173,7 +338,7 @@ class ChatGPT(API):
         
         #br 获取对话
         url = '{}/api/conversation/{}'.format(self.api_prefix, conversation_id)
-        resp = self.session.get(url=url, headers=self.__get_headers(token), **self.req_kwargs)
+        resp = self.__cached_get(url, token, ('conversation', conversation_id), self.cache_ttl)
 
         if raw:
             return resp
@@ -190,6 +355,7 @@ class ChatGPT(API):
 
         url = '{}/api/conversations'.format(self.api_prefix)
         resp = self.session.patch(url=url, headers=self.__get_headers(token), json=data, **self.req_kwargs)
+        self.__invalidate(token, all_conversations=True)
 
         if raw:
             return resp
@@ -217,6 +383,7 @@ class ChatGPT(API):
             'message_id': message_id,
         }
         resp = self.session.post(url=url, headers=self.__get_headers(token), json=data, **self.req_kwargs)
+        self.__invalidate(token, conversation_id)
 
         if raw:
             return resp
@@ -237,7 +404,8 @@ class ChatGPT(API):
 
         return self.__update_conversation(conversation_id, data, raw, token)
 
-    def talk(self, prompt, model, message_id, parent_message_id, conversation_id=None, stream=True, token=None):
+    def talk(self, prompt, model, message_id, parent_message_id, conversation_id=None, stream=True, token=None,
+             delta=False):
         data = {
             #br 将用户的prompt打包
             'action': 'next',
@@ -261,9 +429,9 @@ class ChatGPT(API):
         if conversation_id:
             data['conversation_id'] = conversation_id
         #br 返回gpt答案
-        return self.__request_conversation(data, token)
+        return self.__request_conversation(data, token, delta)
 
-    def goon(self, model, parent_message_id, conversation_id, stream=True, token=None):
+    def goon(self, model, parent_message_id, conversation_id, stream=True, token=None, delta=False):
         data = {
             'action': 'continue',
             'conversation_id': conversation_id,
@@ -271,9 +439,10 @@ class ChatGPT(API):
             'parent_message_id': parent_message_id,
         }
 
-        return self.__request_conversation(data, token)
+        return self.__request_conversation(data, token, delta)
 
-    def regenerate_reply(self, prompt, model, conversation_id, message_id, parent_message_id, stream=True, token=None):
+    def regenerate_reply(self, prompt, model, conversation_id, message_id, parent_message_id, stream=True, token=None,
+                         delta=False):
         data = {
             'action': 'variant',
             'messages': [
@@ -294,18 +463,73 @@ class ChatGPT(API):
             'parent_message_id': parent_message_id,
         }
 
-        return self.__request_conversation(data, token)
+        return self.__request_conversation(data, token, delta)
 
-    def __request_conversation(self, data, token=None):
+    def __request_conversation(self, data, token=None, delta=False):
         #br 获取gpt对话
         url = '{}/api/conversation'.format(self.api_prefix)
         headers = {**self.session.headers, **self.__get_headers(token), 'Accept': 'text/event-stream'}
 
-        return self._request_sse(url, headers, data)
+        conversation_id = data.get('conversation_id')
+        self.__invalidate(token, conversation_id)
+
+        token_key = token or self.default_token_key
+        try:
+            waited = rate_limiter.acquire(token_key, self.__count_tokens(data))
+        except RateLimitTimeout as e:
+            return self._out_rate_limited({'detail': str(e)}, e.retry_after)
+
+        status, headers, generator = self._request_sse(url, headers, data)
+        self._after_rate_limit(token_key, status, headers, waited)
+        generator.callbacks.append(lambda: self.__invalidate(token, conversation_id))
+
+        if delta and 200 == status:
+            generator = self.__delta_wrap(generator)
+
+        return status, headers, generator
+
+    @staticmethod
+    def __count_tokens(data):
+        if not rate_limiter.tpm or not data.get('messages'):
+            return 0
+
+        messages = [{
+            'role': x['author']['role'],
+            'content': ''.join(p for p in x['content']['parts'] if isinstance(p, str)),
+        } for x in data['messages']]
+
+        return gpt_num_tokens(messages)
+
+    @staticmethod
+    def __delta_wrap(generator):
+        offsets = {}
+        try:
+            for line in generator:
+                message = line.get('message')
+                if not message:
+                    yield line
+                    continue
+
+                parts = message['content'].get('parts') or ['']
+                text = parts[0] if isinstance(parts[0], str) else ''
+                offset = offsets.get(message['id'], 0)
+                offsets[message['id']] = len(text)
+
+                yield {
+                    'message_id': message['id'],
+                    'role': message['author']['role'],
+                    'conversation_id': line.get('conversation_id'),
+                    'delta': text[offset:],
+                    'end_turn': message.get('end_turn'),
+                    'error': line.get('error'),
+                }
+        finally:
+            generator.close()
 
     def __update_conversation(self, conversation_id, data, raw=False, token=None):
         url = '{}/api/conversation/{}'.format(self.api_prefix, conversation_id)
         resp = self.session.patch(url=url, headers=self.__get_headers(token), json=data, **self.req_kwargs)
+        self.__invalidate(token, conversation_id)
 
         if raw:
             return resp
@@ -329,7 +553,7 @@ class ChatGPT(API):
 
 class ChatCompletion(API):
     def __init__(self, proxy=None):
-        self.session = requests.Session()
+        self.session = client_pool.mount(requests.Session())
         self.req_kwargs = {
             'proxies': {
                 'http': proxy,
@@ -343,6 +567,7 @@ class ChatCompletion(API):
         self.user_agent = 'pandora/{}'.format(__version__)
 
         super().__init__(proxy, self.req_kwargs['verify'])
+        self.req_kwargs['timeout'] = (self.connect_timeout, self.req_kwargs['timeout'])
 
     def __get_headers(self, api_key):
         return {
@@ -364,11 +589,21 @@ class ChatCompletion(API):
     def __request_conversation(self, api_key, data, stream):
         url = '{}/v1/chat/completions'.format(getenv('OPENAI_API_PREFIX', 'https://api.openai.com'))
 
+        try:
+            tokens = gpt_num_tokens(data['messages'], data['model']) if rate_limiter.tpm else 0
+            waited = rate_limiter.acquire(api_key, tokens + data.get('max_tokens', 0))
+        except RateLimitTimeout as e:
+            return self._out_rate_limited({'error': {'message': str(e)}}, e.retry_after)
+
         if stream:
             headers = {**self.__get_headers(api_key), 'Accept': 'text/event-stream'}
-            return self._request_sse(url, headers, data)
+            status, headers, generator = self._request_sse(url, headers, data, True)
+            self._after_rate_limit(api_key, status, headers, waited)
+
+            return status, headers, generator
 
         resp = self.session.post(url=url, headers=self.__get_headers(api_key), json=data, **self.req_kwargs)
+        self._after_rate_limit(api_key, resp.status_code, resp.headers, waited)
 
         def __generate_wrap():
             yield resp.json()
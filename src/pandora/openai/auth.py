@@ -9,6 +9,8 @@ from urllib.parse import urlparse, parse_qs
 import requests
 from certifi import where
 
+from .pool import pool
+
 
 class Auth0:
     def __init__(self, email: str, password: str, proxy: str = None, use_cache: bool = True):
@@ -16,7 +18,7 @@ class Auth0:
         self.email = email
         self.password = password
         self.use_cache = use_cache
-        self.session = requests.Session()
+        self.session = pool.mount(requests.Session())
         self.req_kwargs = {
             'proxies': {
                 'http': proxy,
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from os import getenv
+
+
+class ResponseCache:
+    """ 免费模式下 GET 请求的响应缓存，键为 (token key, 类型, 参数)，按过期时间和容量淘汰。
+    1. 只缓存成功的响应，会话有修改时主动失效对应的缓存。
+    2. 每个 token key 有一个版本号，失效时加一，请求开始前的版本与写入时不一致则放弃写入，避免缓存修改前的旧数据。
+    3. 多进程模式下缓存只在本进程内有效，其他进程最多在过期时间内读到旧数据。
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.reset()
+
+    def reset(self):
+        self.__data = OrderedDict()
+        self.__versions = {}
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def version(self, token_key):
+        return self.__versions.get(token_key, 0)
+
+    def get(self, key):
+        with self.__lock:
+            item = self.__data.get(key)
+            if item and item[0] > time.monotonic():
+                self.__data.move_to_end(key)
+                self.__hits += 1
+
+                return item[1]
+
+            if item:
+                del self.__data[key]
+
+            self.__misses += 1
+
+        return None
+
+    def set(self, key, value, ttl, version):
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+
+        with self.__lock:
+            if version != self.__versions.get(key[0], 0):
+                return
+
+            self.__data[key] = (time.monotonic() + ttl, value)
+            self.__data.move_to_end(key)
+
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+                self.__evictions += 1
+
+    def invalidate(self, token_key, kind, arg=None):
+        with self.__lock:
+            self.__versions[token_key] = self.__versions.get(token_key, 0) + 1
+
+            for key in [x for x in self.__data if token_key == x[0] and kind == x[1] and arg in (None, x[2])]:
+                del self.__data[key]
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'size': len(self.__data),
+                'maxsize': self.maxsize,
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'evictions': self.__evictions,
+            }
+
+
+class SingleFlight:
+    """ 相同的并发读请求只向上游发出一次，其余的请求等待并共用同一个结果（或异常）。 """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.__calls = {}
+        self.__lock = threading.Lock()
+        self.__requests = 0
+        self.__shared = 0
+
+    def do(self, key, func):
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self.__calls[key] = {'event': threading.Event(), 'result': None, 'error': None}
+                self.__requests += 1
+            else:
+                self.__shared += 1
+
+        if leader:
+            try:
+                call['result'] = func()
+            except BaseException as e:
+                call['error'] = e
+            finally:
+                with self.__lock:
+                    del self.__calls[key]
+
+                call['event'].set()
+        else:
+            call['event'].wait()
+
+        if call['error']:
+            raise call['error']
+
+        return call['result']
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'in_flight': len(self.__calls),
+                'requests': self.__requests,
+                'shared': self.__shared,
+            }
+
+
+cache = ResponseCache(int(getenv('PANDORA_CACHE_SIZE', 1000)))
+single_flight = SingleFlight()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=cache.reset)
+    os.register_at_fork(after_in_child=single_flight.reset)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DONE_FRAME = b'data: [DONE]\n\n'
+
+if orjson:
+    name = 'orjson'
+    loads = orjson.loads
+    dumps = orjson.dumps
+else:
+    name = 'json'
+    loads = json.loads
+
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def frame(obj):
+    return b''.join((b'data: ', dumps(obj), b'\n\n'))
+
+
+class EventParser:
+    """ 把SSE的字节流切分成行，只解码 data 中的 JSON，[DONE] 之后的内容忽略。 """
+
+    def __init__(self):
+        self.buffer = b''
+        self.done = False
+
+    def feed(self, chunk):
+        lines = (self.buffer + chunk).split(b'\n')
+        self.buffer = lines.pop()
+
+        return self.__parse(lines)
+
+    def flush(self):
+        lines, self.buffer = [self.buffer], b''
+
+        return self.__parse(lines)
+
+    def __parse(self, lines):
+        events = []
+        for line in lines:
+            if self.done:
+                break
+
+            if b'data: [DONE]' == line[0:12]:
+                self.done = True
+            elif b'data: {' == line[0:7]:
+                events.append(loads(line[6:]))
+
+        return events
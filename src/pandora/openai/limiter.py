@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from os import getenv
+
+
+def parse_retry_after(value, default):
+    if not value:
+        return default
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimitTimeout(Exception):
+    def __init__(self, retry_after):
+        super().__init__('Too many requests, please try again later')
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """ 按 token key 限制发往上游的请求数（rpm）和 token 数（tpm），两者都是容量为一分钟额度的令牌桶，为 0 表示不限制。
+    1. 同一个 key 的请求按到达顺序排队放行，排在前面的请求没有放行时后面的请求不会插队。
+    2. 排队超过 timeout 秒的请求放弃排队，由调用方返回 429。
+    3. 上游返回 429 时按 Retry-After 暂停该 key 的放行。
+    """
+
+    def __init__(self, rpm=0, tpm=0, timeout=60.0, cooldown=20.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self.reset()
+
+    def reset(self):
+        self.__states = {}
+        self.__lock = threading.Lock()
+        self.__admitted = 0
+        self.__rejected = 0
+        self.__wait_time = 0.0
+        self.__max_wait = 0.0
+
+    @property
+    def enabled(self):
+        return self.rpm > 0 or self.tpm > 0
+
+    def acquire(self, key, tokens=0):
+        if not self.enabled:
+            return 0.0
+
+        tokens = min(tokens, self.tpm) if self.tpm > 0 else 0
+        start = time.monotonic()
+        deadline = start + self.timeout
+
+        with self.__lock:
+            state = self.__get_state(key, start)
+            ticket = object()
+            state['queue'].append(ticket)
+
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self.__get_delay(state, tokens, now) if state['queue'][0] is ticket else None
+                    if 0 == delay:
+                        state['requests'] -= 1
+                        state['tokens'] -= tokens
+                        break
+
+                    if now >= deadline:
+                        self.__rejected += 1
+                        raise RateLimitTimeout(delay or self.timeout)
+
+                    state['cond'].wait(deadline - now if delay is None else min(delay, deadline - now))
+            finally:
+                state['queue'].remove(ticket)
+                state['cond'].notify_all()
+
+            waited = time.monotonic() - start
+            self.__admitted += 1
+            self.__wait_time += waited
+            self.__max_wait = max(self.__max_wait, waited)
+
+        return waited
+
+    def backoff(self, key, retry_after=None):
+        if not self.enabled:
+            return
+
+        with self.__lock:
+            now = time.monotonic()
+            state = self.__get_state(key, now)
+            state['paused_until'] = max(state['paused_until'], now + parse_retry_after(retry_after, self.cooldown))
+
+    def __get_state(self, key, now):
+        state = self.__states.get(key)
+        if not state:
+            state = self.__states[key] = {
+                'requests': float(self.rpm),
+                'tokens': float(self.tpm),
+                'updated': now,
+                'paused_until': 0.0,
+                'queue': deque(),
+                'cond': threading.Condition(self.__lock),
+            }
+
+        return state
+
+    def __get_delay(self, state, tokens, now):
+        elapsed = now - state['updated']
+        state['updated'] = now
+
+        delay = state['paused_until'] - now
+
+        if self.rpm > 0:
+            state['requests'] = min(self.rpm, state['requests'] + elapsed * self.rpm / 60)
+            delay = max(delay, (1 - state['requests']) * 60 / self.rpm)
+
+        if self.tpm > 0:
+            state['tokens'] = min(self.tpm, state['tokens'] + elapsed * self.tpm / 60)
+            delay = max(delay, (tokens - state['tokens']) * 60 / self.tpm)
+
+        return delay if delay > 0 else 0
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'rpm': self.rpm,
+                'tpm': self.tpm,
+                'keys': len(self.__states),
+                'queued': sum(len(x['queue']) for x in self.__states.values()),
+                'admitted': self.__admitted,
+                'rejected': self.__rejected,
+                'wait_time': round(self.__wait_time, 3),
+                'max_wait': round(self.__max_wait, 3),
+            }
+
+
+limiter = RateLimiter(int(getenv('PANDORA_RATE_LIMIT_RPM', 0)), int(getenv('PANDORA_RATE_LIMIT_TPM', 0)),
+                      float(getenv('PANDORA_RATE_LIMIT_TIMEOUT', 60)))
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=limiter.reset)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import threading
+import time
+from os import getenv
+
+import httpx
+from requests.adapters import HTTPAdapter
+
+
+class ClientPool:
+    """ 进程内共享的上游连接池，ChatGPT、ChatCompletion、Auth0 共用，避免每次请求都重新握手。
+    1. 流式请求使用 httpx.AsyncClient，每个事件循环、代理组合各保留一个长连接客户端。
+    2. 普通请求使用 requests，所有 Session 挂载同一个 HTTPAdapter，各自的 Cookie 互不影响。
+    3. fork 出的子进程调用 reset 丢弃从父进程继承的连接，不与父进程共用 socket。
+    4. 流式请求的连接数由 max_streams 限制，为 0 表示不限制，每个 SSE 流会占用一个连接直到结束。
+    """
+
+    def __init__(self, max_connections=100, max_keepalive=20, keepalive_expiry=30.0, http2=False, max_streams=0):
+        self.limits = httpx.Limits(max_connections=max_streams or None, max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.http2 = http2 and self.__support_http2()
+        self.adapter = HTTPAdapter(pool_connections=max_keepalive, pool_maxsize=max_connections)
+        self.reset()
+
+    def reset(self):
+        self.adapter.close()
+
+        self.__clients = {}
+        self.__lock = threading.Lock()
+        self.__requests = 0
+        self.__hits = 0
+        self.__new_connections = 0
+        self.__wait_time = 0.0
+        self.__counters = {'retries': 0, 'hedged': 0, 'hedge_wins': 0, 'relayed': 0}
+
+    @staticmethod
+    def __support_http2():
+        try:
+            import h2
+        except ImportError:
+            return False
+
+        return True
+
+    def mount(self, session):
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+
+        return session
+
+    def get_async_client(self, proxy, verify):
+        key = (asyncio.get_event_loop(), proxy, verify)
+
+        with self.__lock:
+            client = self.__clients.get(key)
+            if not client:
+                client = httpx.AsyncClient(verify=verify, proxies=proxy, limits=self.limits, http2=self.http2)
+                self.__clients[key] = client
+
+        return client
+
+    def trace(self):
+        started = time.perf_counter()
+        state = {'acquired': False, 'connected': False}
+
+        async def __trace(name, info):
+            if not state['acquired']:
+                state['acquired'] = True
+                with self.__lock:
+                    self.__wait_time += time.perf_counter() - started
+
+            if 'connection.connect_tcp.started' == name:
+                state['connected'] = True
+            elif name.endswith('send_request_headers.started'):
+                with self.__lock:
+                    self.__requests += 1
+                    if state['connected']:
+                        self.__new_connections += 1
+                    else:
+                        self.__hits += 1
+
+        return {'trace': __trace}
+
+    def record(self, name):
+        with self.__lock:
+            self.__counters[name] += 1
+
+    def stats(self):
+        with self.__lock:
+            counters = dict(self.__counters)
+            stream = {
+                'clients': len(self.__clients),
+                'requests': self.__requests,
+                'hits': self.__hits,
+                'new_connections': self.__new_connections,
+                'wait_time': round(self.__wait_time, 6),
+            }
+
+        managers = [self.adapter.poolmanager] + list(self.adapter.proxy_manager.values())
+        requests, new_connections = 0, 0
+        for manager in managers:
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool:
+                    requests += pool.num_requests
+                    new_connections += pool.num_connections
+
+        return {
+            'stream': stream,
+            'request': {
+                'requests': requests,
+                'hits': requests - new_connections,
+                'new_connections': new_connections,
+            },
+            'http2': self.http2,
+            **counters,
+        }
+
+
+pool = ClientPool(int(getenv('PANDORA_POOL_MAX_CONNECTIONS', 100)), int(getenv('PANDORA_POOL_MAX_KEEPALIVE', 20)),
+                  float(getenv('PANDORA_POOL_KEEPALIVE_EXPIRY', 30)),
+                  getenv('PANDORA_HTTP2', '').lower() in ('1', 'true', 'yes', 'on'),
+                  int(getenv('PANDORA_POOL_MAX_STREAMS', 0)))
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=pool.reset)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from . import codec
+
+
+class Result:
+    """ 非流式接口的返回结果，内容在送到客户端的过程中只序列化一次。
+    1. data 为原始数据，非 raw 调用直接使用，不经过编码再解码。
+    2. content 为已编码的字节，chunks 为分块输出字节的可迭代对象，server 直接写出，不经过解码再编码。
+    3. api 模式由 TurboGPT 构造；免费模式下 GET 请求的上游响应按块转发，较小的响应体读完后缓存。
+    """
+
+    __slots__ = ('status_code', 'content_type', '__data', '__content', '__chunks')
+
+    def __init__(self, data=None, status=200, content=None, chunks=None, content_type='application/json'):
+        self.status_code = status
+        self.content_type = content_type
+        self.__data = data
+        self.__content = content
+        self.__chunks = chunks
+
+    def json(self):
+        return codec.loads(self.content) if self.__data is None else self.__data
+
+    @property
+    def content(self):
+        if self.__content is None:
+            if self.__chunks is not None:
+                self.__content, self.__chunks = b''.join(self.__chunks), None
+            else:
+                self.__content = codec.dumps(self.__data)
+
+        return self.__content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def get_body(self):
+        """ 返回 bytes 或分块的可迭代对象，分块的内容只能读一次。 """
+        if self.__chunks is not None:
+            chunks, self.__chunks = self.__chunks, None
+            return chunks
+
+        return self.content
+
+
+class ReleasingIterator:
+    """ 包装生成器，迭代结束、出错或被关闭时调用一次 callback。
+    生成器在第一次 next 之前被关闭时不会执行其中的 finally，由这里保证占用的资源总能释放。
+    """
+
+    def __init__(self, generator, callback):
+        self.generator = generator
+        self.callback = callback
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.generator)
+        except BaseException:
+            self.close()
+            raise
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        callback, self.callback = self.callback, None
+        if not callback:
+            return
+
+        try:
+            self.generator.close()
+        finally:
+            callback()
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import contextvars
+import os
+import queue as block_queue
+import threading
+import weakref
+from collections import deque
+from os import getenv
+
+from .codec import loads, EventParser
+
+
+class StreamChannel:
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, loop, maxsize, disconnected=None):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.disconnected = disconnected
+        self.queue = block_queue.Queue()
+        self.slots = None
+        self.future = None
+        self.finished = False
+        self.closed = False
+        self.readiness = None
+        self.__waiters = []
+        self.__lock = threading.Lock()
+
+    async def put(self, item):
+        await self.slots.acquire()
+        self.queue.put(item)
+        self.__notify()
+
+    def put_nowait(self, item):
+        self.queue.put(item)
+        self.__notify()
+
+    def finish(self):
+        self.finished = True
+        self.put_nowait(None)
+
+    def wait_ready(self, loop):
+        future = loop.create_future()
+
+        with self.__lock:
+            if self.finished or self.queue.qsize():
+                future.set_result(None)
+            else:
+                self.__waiters.append((loop, future))
+
+        return future
+
+    def __notify(self):
+        with self.__lock:
+            waiters, self.__waiters = self.__waiters, []
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self.__wake, future)
+
+    @staticmethod
+    def __wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def get(self):
+        item = self.__poll() if self.disconnected else self.queue.get()
+        return self.__take(item)
+
+    def get_nowait(self):
+        return self.__take(self.queue.get_nowait())
+
+    def __take(self, item):
+        if isinstance(item, BaseException):
+            raise item
+
+        if item is not None:
+            self.loop.call_soon_threadsafe(self.slots.release)
+
+        return item
+
+    def __poll(self):
+        while True:
+            try:
+                return self.queue.get(timeout=self.POLL_INTERVAL)
+            except block_queue.Empty:
+                if self.disconnected():
+                    self.close()
+                    return None
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def ready(self):
+        """ 消费端下一次读取是否不会阻塞。消费端自己缓冲数据时通过 readiness 登记判断方法。 """
+        readiness = self.readiness and self.readiness()
+        if readiness:
+            return readiness()
+
+        return self.finished or self.queue.qsize() > 0
+
+    def close(self):
+        self.closed = True
+        if self.future and not self.future.done():
+            self.future.cancel()
+
+
+class EventStream:
+    """ 上游SSE流的读取端，队列中是上游原始的字节块。
+    1. chunks 原样输出字节块，用于直接转发，可以传入 tap 在转发的同时解析出事件。
+    2. 按迭代器使用时才切分、解码为 dict，解码发生在读取的线程中，不占用事件循环。
+    3. 状态码不是 200 时，迭代得到的是整个响应体解码后的内容。
+    4. callbacks 在流结束或被关闭时调用一次。
+    5. ready 不阻塞地读入已到达的字节块，有完整的事件可以返回时才为 True，一个字节块中的多个事件逐个返回，
+       只有半行时不算就绪。
+    """
+
+    def __init__(self, channel, status=200):
+        self.channel = channel
+        self.status = status
+        self.finished = False
+        self.callbacks = []
+        self.__events = deque()
+        self.__parser = EventParser()
+        self.__body = []
+        self.__ended = False
+        self.__error = None
+
+        channel.readiness = weakref.WeakMethod(self.ready)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.__events:
+            if self.__error:
+                error, self.__error = self.__error, None
+                raise error
+
+            if self.__ended:
+                raise StopIteration
+
+            self.__decode(None if self.finished else self.channel.get())
+
+        return self.__events.popleft()
+
+    def __del__(self):
+        self.close()
+
+    def ready(self):
+        while not self.__events and not self.__ended:
+            if self.finished or self.__error:
+                return True
+
+            try:
+                item = self.channel.get_nowait()
+            except block_queue.Empty:
+                return False
+            except BaseException as e:
+                self.__error = e
+                return True
+
+            self.__decode(item)
+
+        return True
+
+    def __read(self):
+        try:
+            while not self.finished:
+                item = self.channel.get()
+                if item is None:
+                    break
+
+                yield item
+        finally:
+            self.close()
+
+    def __decode(self, item):
+        if item is None:
+            self.__ended = True
+            self.close()
+
+            if 200 == self.status:
+                self.__events.extend(self.__parser.flush())
+            else:
+                self.__events.append(loads(b''.join(self.__body)))
+            return
+
+        if 200 != self.status:
+            self.__body.append(item)
+            return
+
+        self.__events.extend(self.__parser.feed(item))
+        if self.__parser.done:
+            self.__decode(None)
+
+    def chunks(self, tap=None):
+        self.channel.readiness = None
+
+        return self.__chunks(tap)
+
+    def __chunks(self, tap):
+        parser = EventParser() if tap else None
+
+        try:
+            for chunk in self.__read():
+                yield chunk
+
+                if parser:
+                    for event in parser.feed(chunk):
+                        tap(event)
+
+            if parser:
+                for event in parser.flush():
+                    tap(event)
+        finally:
+            self.close()
+
+    def close(self):
+        self.finished = True
+        self.channel.close()
+
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class StreamEngine:
+    """ 所有上游SSE流共用的后台事件循环，避免每个请求都新建线程和事件循环。
+    1. 后台线程在首次使用时才启动，每个线程运行一个常驻的事件循环，多个循环之间轮询分配。
+    2. 每个流对应一个 StreamChannel，生产端在事件循环中写入，消费端在WSGI工作线程中阻塞读取。
+    3. 队列长度受 maxsize 限制，消费端读取过慢时生产端会在事件循环中等待，而不会阻塞事件循环。
+    4. 异步的消费端可以通过 wait_ready 等待数据到达后再读取，capture 用于收集一次调用中打开的流。
+    5. fork 出的子进程不会继承后台线程，reset 后在子进程中重新启动。
+    6. watch 登记当前请求的客户端断开检测函数，之后打开的流在等待数据时定时检查，客户端断开后立即取消上游请求。
+    """
+
+    __captured = contextvars.ContextVar('pandora_stream_captured', default=None)
+    __disconnected = contextvars.ContextVar('pandora_stream_disconnected', default=None)
+
+    def __init__(self, loops=1, queue_size=64):
+        self.loops_num = max(1, loops)
+        self.queue_size = max(1, queue_size)
+        self.reset()
+
+    def reset(self):
+        self.__loops = []
+        self.__next = 0
+        self.__lock = threading.Lock()
+        self.__channels = set()
+
+    def __start(self):
+        for i in range(self.loops_num):
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=self.__run_loop, args=(loop,), name='pandora-stream-{}'.format(i),
+                                      daemon=True)
+            thread.start()
+            self.__loops.append(loop)
+
+    @staticmethod
+    def __run_loop(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def __get_loop(self):
+        with self.__lock:
+            if not self.__loops:
+                self.__start()
+
+            loop = self.__loops[self.__next % self.loops_num]
+            self.__next += 1
+
+            return loop
+
+    def open(self, generator):
+        loop = self.__get_loop()
+        channel = StreamChannel(loop, self.queue_size, self.__disconnected.get())
+        channel.future = asyncio.run_coroutine_threadsafe(self.__pump(channel, generator), loop)
+
+        captured = self.__captured.get()
+        if captured is not None:
+            captured.append(channel)
+
+        return channel
+
+    def watch(self, disconnected):
+        self.__disconnected.set(disconnected)
+
+    def capture(self, func, *args):
+        channels = []
+        token = self.__captured.set(channels)
+
+        try:
+            return func(*args), channels
+        finally:
+            self.__captured.reset(token)
+
+    async def __pump(self, channel, generator):
+        channel.slots = asyncio.Semaphore(channel.maxsize)
+
+        with self.__lock:
+            self.__channels.add(channel)
+
+        try:
+            async for item in generator:
+                await channel.put(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            channel.put_nowait(e)
+        finally:
+            await generator.aclose()
+            channel.finish()
+
+            with self.__lock:
+                self.__channels.discard(channel)
+
+    def stats(self):
+        with self.__lock:
+            sizes = [channel.qsize() for channel in self.__channels]
+
+        return {
+            'loops': len(self.__loops),
+            'streams': len(sizes),
+            'queued': sum(sizes),
+            'max_queued': max(sizes) if sizes else 0,
+            'queue_size': self.queue_size,
+        }
+
+
+engine = StreamEngine(int(getenv('PANDORA_STREAM_LOOPS', 1)), int(getenv('PANDORA_STREAM_QUEUE_SIZE', 64)))
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=engine.reset)
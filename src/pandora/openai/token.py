@@ -1,18 +1,103 @@
 # -*- coding: utf-8 -*-
 
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+from os import getenv
+
 import tiktoken
 
+__encodings = {}
+__encodings_lock = threading.Lock()
+
+
+class TokenCache:
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(encoding, text):
+        return encoding.name, blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, key):
+        with self.__lock:
+            value = self.__data.get(key)
+            if value is not None:
+                self.__data.move_to_end(key)
+
+            return value
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__data[key] = value
+            self.__data.move_to_end(key)
+
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+
+__token_cache = TokenCache(int(getenv('API_TOKEN_CACHE_SIZE', 10000)))
+
+
+def get_encoding(model='gpt-3.5-turbo'):
+    encoding = __encodings.get(model)
+    if encoding:
+        return encoding
+
+    with __encodings_lock:
+        if model not in __encodings:
+            try:
+                __encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                __encodings[model] = tiktoken.get_encoding('cl100k_base')
+
+        return __encodings[model]
+
 
 def gpt_num_tokens(messages, model='gpt-3.5-turbo'):
-    encoding = tiktoken.encoding_for_model(model)
+    return sum(gpt_messages_num_tokens(messages, model)) + 2
+
+
+def gpt_message_num_tokens(message, model='gpt-3.5-turbo'):
+    encoding = get_encoding(model)
+
+    num_tokens = 4
+    for key, value in message.items():
+        num_tokens += __text_num_tokens(encoding, value)
+        if 'name' == key:
+            num_tokens -= 1
+
+    return num_tokens
+
 
-    num_tokens = 0
+def gpt_messages_num_tokens(messages, model='gpt-3.5-turbo', num_threads=8, batch_threshold=32):
+    encoding = get_encoding(model)
+
+    missing = {}
     for message in messages:
-        num_tokens += 4
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if 'name' == key:
-                num_tokens -= 1
-    num_tokens += 2
+        for value in message.values():
+            key = __token_cache.key(encoding, value)
+            if key not in missing and __token_cache.get(key) is None:
+                missing[key] = value
+
+    # encode_batch 每次都会新建线程池，只有待计算的文本较多时才值得使用
+    if len(missing) >= batch_threshold:
+        keys = list(missing)
+        tokens = encoding.encode_batch([missing[key] for key in keys], num_threads=num_threads)
+        for key, encoded in zip(keys, tokens):
+            __token_cache.set(key, len(encoded))
+
+    return [gpt_message_num_tokens(message, model) for message in messages]
+
+
+def __text_num_tokens(encoding, text):
+    key = __token_cache.key(encoding, text)
+
+    num_tokens = __token_cache.get(key)
+    if num_tokens is None:
+        num_tokens = len(encoding.encode(text))
+        __token_cache.set(key, num_tokens)
 
     return num_tokens
@@ -1,38 +1,100 @@
 # -*- coding: utf-8 -*-
 
+import threading
 import uuid
+from array import array
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime as dt
+from itertools import islice, dropwhile
+
+from ..openai import codec
+from ..openai.token import gpt_message_num_tokens, gpt_messages_num_tokens
+
+ConversationItem = namedtuple('ConversationItem', ['conversation_id', 'title', 'create_time'])
 
 
 class Prompt:
+    """ 会话中的一条消息，父子关系由所属的 Conversation 按下标保存，prompt 本身只记录 index 和 parent。
+    parent 在加入会话前可以是父 prompt 的 id（从数据库恢复时），加入后统一换成父节点的下标，没有父节点时为 -1。
+    fragment 缓存该 prompt 在会话详情 mapping 中序列化后的字节，内容或子节点变化时由 invalidate 清除。
+    """
+
+    __slots__ = ('index', 'parent', 'prompt_id', 'role', 'content', 'create_time', 'model', 'num_tokens',
+                 'chat_message', 'fragment', 'version')
+
     def __init__(self, prompt_id=None, role=None, content=None, parent=None):
+        self.index = -1
+        self.parent = parent.index if parent else -1
         self.prompt_id = prompt_id or str(uuid.uuid4())
-        self.parent_id = None
         self.role = role
         self.content = content
-        self.children = []
         self.create_time = dt.now().timestamp()
+        self.model = None
+        self.num_tokens = None
+        self.chat_message = None
+        self.fragment = None
+        self.version = 0
+
+    def invalidate(self):
+        self.version += 1
+        self.fragment = None
+
+    def get_chat_message(self):
+        if self.chat_message is None:
+            self.chat_message = {
+                'role': self.role,
+                'content': self.content,
+            }
+
+        return self.chat_message
+
+    def get_num_tokens(self, model='gpt-3.5-turbo'):
+        if self.num_tokens is None:
+            self.num_tokens = {}
 
-        if parent:
-            self.parent_id = parent.prompt_id
-            parent.add_child(self.prompt_id)
+        if model not in self.num_tokens:
+            self.num_tokens[model] = gpt_message_num_tokens(self.get_chat_message(), model)
 
-    def add_child(self, prompt_id):
-        self.children.append(prompt_id)
+        return self.num_tokens[model]
+
+    @staticmethod
+    def count_tokens(prompts, model='gpt-3.5-turbo'):
+        missing = [prompt for prompt in prompts if not prompt.num_tokens or model not in prompt.num_tokens]
+        if len(missing) > 1:
+            counts = gpt_messages_num_tokens([prompt.get_chat_message() for prompt in missing], model)
+            for prompt, num_tokens in zip(missing, counts):
+                if prompt.num_tokens is None:
+                    prompt.num_tokens = {}
+
+                prompt.num_tokens[model] = num_tokens
+
+        return sum(prompt.get_num_tokens(model) for prompt in prompts)
 
     def get_message(self, end=True):
         return None
 
-    def get_info(self):
+    @classmethod
+    def restore(cls, prompt_id, parent_id, role, content, create_time, model=None):
+        prompt = cls.__new__(cls)
+        Prompt.__init__(prompt, prompt_id, role, content)
+        prompt.parent = parent_id or -1
+        prompt.create_time = create_time
+        prompt.model = model
+
+        return prompt
+
+    def get_info(self, parent_id, children):
         return {
             'id': self.prompt_id,
             'message': self.get_message(),
-            'parent': self.parent_id,
-            'children': self.children
+            'parent': parent_id,
+            'children': children
         }
 
 
 class SystemPrompt(Prompt):
+    __slots__ = ()
+
     def __init__(self, content, parent):
         super().__init__(role='system', content=content, parent=parent)
 
@@ -58,6 +120,8 @@ class SystemPrompt(Prompt):
 
 
 class UserPrompt(Prompt):
+    __slots__ = ()
+
     def __init__(self, prompt_id, content, parent):
         super().__init__(prompt_id=prompt_id, role='user', content=content, parent=parent)
 
@@ -86,12 +150,58 @@ class UserPrompt(Prompt):
 
 
 class GptPrompt(Prompt):
+    """ 生成中的回复按片段追加，读取时才拼接成字符串。每个 prompt 使用自己的锁，各个会话的生成互不等待。 """
+
+    __slots__ = ('__parts', '__lock')
+
     def __init__(self, parent, model):
+        self.__lock = threading.Lock()
         super().__init__(role='assistant', content='', parent=parent)
         self.model = model
 
+    @classmethod
+    def restore(cls, *args, **kwargs):
+        prompt = super().restore(*args, **kwargs)
+        prompt.__lock = threading.Lock()
+
+        return prompt
+
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in Prompt.__slots__}
+        state['content'] = self.content
+
+        return state
+
+    def __setstate__(self, state):
+        self.__lock = threading.Lock()
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def content(self):
+        with self.__lock:
+            if not isinstance(self.__parts, str):
+                self.__parts = ''.join(self.__parts)
+
+            return self.__parts
+
+    @content.setter
+    def content(self, content):
+        self.__parts = content or ''
+
     def append_content(self, content):
-        self.content += content
+        if content:
+            with self.__lock:
+                if not self.__parts:
+                    self.__parts = content
+                elif isinstance(self.__parts, str):
+                    self.__parts = [self.__parts, content]
+                else:
+                    self.__parts.append(content)
+
+            self.num_tokens = None
+            self.chat_message = None
+            self.invalidate()
 
         return self
 
@@ -124,24 +234,146 @@ class GptPrompt(Prompt):
 
 
 class Conversation:
+    """ 会话中的 prompt 按加入顺序编号，父子关系和路径缓存都用下标保存在数组里，prompt id 只在接口处转换。
+    1. 子节点按加入顺序用 first_child / next_sibling 串起来，last_child 用于在末尾追加。
+    2. 每个分支共用一个路径列表，每个节点只记录自己的前缀长度。
+    """
+
     def __init__(self):
+        self.__lock = threading.Lock()
         self.conversation_id = str(uuid.uuid4())
         self.title = 'New chat'
         self.create_time = dt.now().timestamp()
         self.current_node = None
-        self.prompts = {}
+        self.deleted = False
+        self.stored = False
+        self.__nodes = []
+        self.__ids = {}
+        self.__parents = array('i')
+        self.__first_child = array('i')
+        self.__last_child = array('i')
+        self.__next_sibling = array('i')
+        self.__path_lists = []
+        self.__path_lengths = array('i')
+        self.__dirty = set()
+
+    @staticmethod
+    def restore(conversation_id, title, create_time, current_node, prompts):
+        conversation = Conversation()
+        conversation.conversation_id = conversation_id
+        conversation.title = title
+        conversation.create_time = create_time
+        conversation.stored = True
+
+        # 按 create_time 依次加入，与会话中原本的加入顺序相同；父节点还没加入的先挂起，父节点加入后紧接着加入
+        waiting = {}
+        for prompt in sorted(prompts, key=lambda x: x.create_time):
+            parent = None if -1 == prompt.parent else conversation.get_prompt(prompt.parent)
+            if -1 != prompt.parent and parent is None:
+                waiting.setdefault(prompt.parent, []).append(prompt)
+                continue
+
+            queue = deque([(prompt, parent)])
+            while queue:
+                prompt, parent = queue.popleft()
+                prompt.parent = parent.index if parent else -1
+                conversation.add_prompt(prompt)
+
+                queue.extend((child, prompt) for child in waiting.pop(prompt.prompt_id, []))
+
+        conversation.current_node = current_node
+        conversation.pop_dirty()
+
+        return conversation
 
     def add_prompt(self, prompt):
-        self.prompts[prompt.prompt_id] = prompt
+        index = len(self.__nodes)
+        parent = prompt.parent
+
+        prompt.index = index
+        self.__nodes.append(prompt)
+        self.__ids[prompt.prompt_id] = index
+        self.__parents.append(parent)
+        self.__first_child.append(-1)
+        self.__last_child.append(-1)
+        self.__next_sibling.append(-1)
+
+        if -1 != parent:
+            if -1 == self.__last_child[parent]:
+                self.__first_child[parent] = index
+            else:
+                self.__next_sibling[self.__last_child[parent]] = index
+            self.__last_child[parent] = index
+            self.__nodes[parent].invalidate()
+
         self.current_node = prompt.prompt_id
+        self.__extend_path(prompt)
+        self.touch(prompt)
 
         return prompt
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_Conversation__lock']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def touch(self, prompt):
+        with self.__lock:
+            self.__dirty.add(prompt.index)
+
+    def pop_dirty(self):
+        with self.__lock:
+            dirty, self.__dirty = self.__dirty, set()
+
+        return [self.__nodes[index] for index in sorted(dirty)]
+
+    def __extend_path(self, prompt):
+        # paths share one list per branch, each prompt only remembers how long its own prefix is
+        parent = prompt.parent
+        if -1 == parent:
+            self.__path_lists.append([])
+            self.__path_lengths.append(0)
+            return
+
+        path, length = self.__path_lists[parent], self.__path_lengths[parent]
+        if path is None:
+            self.__path_lists.append(None)
+            self.__path_lengths.append(0)
+            return
+
+        if len(path) != length:
+            path = path[:length]
+
+        path.append(prompt)
+        self.__path_lists.append(path)
+        self.__path_lengths.append(length + 1)
+
     def get_prompt(self, prompt_id):
-        return self.prompts.get(prompt_id)
+        index = self.__ids.get(prompt_id)
+
+        return None if index is None else self.__nodes[index]
 
     def get_prompts(self):
-        return self.prompts
+        return [self.__nodes[index] for index in self.__ids.values()]
+
+    def get_parent_id(self, prompt):
+        parent = self.__parents[prompt.index]
+
+        return None if -1 == parent else self.__nodes[parent].prompt_id
+
+    def get_children_ids(self, prompt):
+        children = []
+        index = self.__first_child[prompt.index]
+        while -1 != index:
+            children.append(self.__nodes[index].prompt_id)
+            index = self.__next_sibling[index]
+
+        return children
 
     def set_title(self, title):
         self.title = title
@@ -149,44 +381,41 @@ class Conversation:
     def get_title(self):
         return self.title
 
-    def get_messages_directly(self, message_id):
-        messages = []
-        while True:
-            prompt = self.get_prompt(message_id)
-            if not prompt.parent_id:
-                break
+    def get_path(self, message_id):
+        index = self.__ids[message_id]
 
-            messages.insert(0, {
-                'role': prompt.role,
-                'content': prompt.content
-            })
-            message_id = prompt.parent_id
+        path = self.__path_lists[index]
+        if path is not None:
+            return path[:self.__path_lengths[index]]
 
-        return messages
+        prompts = []
+        while -1 != self.__parents[index]:
+            prompts.append(self.__nodes[index])
+            index = self.__parents[index]
+
+        prompts.reverse()
+
+        return prompts
+
+    def get_messages_directly(self, message_id):
+        return [prompt.get_chat_message() for prompt in self.get_path(message_id)]
 
     def get_messages(self, message_id, model):
-        messages = []
-        user_prompt = None
-        while True:
-            prompt = self.get_prompt(message_id)
-            if not prompt.parent_id:
-                break
+        prompts = self.get_path(message_id)
 
-            if not user_prompt and isinstance(prompt, UserPrompt):
+        user_prompt = None
+        for prompt in reversed(prompts):
+            if isinstance(prompt, UserPrompt):
                 user_prompt = prompt
+                break
 
-            messages.insert(0, {
-                'role': prompt.role,
-                'content': prompt.content
-            })
-            message_id = prompt.parent_id
-
-        return user_prompt, self.add_prompt(GptPrompt(user_prompt, model)), messages
+        return user_prompt, self.add_prompt(GptPrompt(user_prompt, model)), prompts
 
     def get_info(self):
         mapping = {}
-        for prompt_id in self.prompts:
-            mapping[prompt_id] = self.prompts[prompt_id].get_info()
+        for prompt_id, index in self.__ids.items():
+            prompt = self.__nodes[index]
+            mapping[prompt_id] = prompt.get_info(self.get_parent_id(prompt), self.get_children_ids(prompt))
 
         return {
             'title': self.title,
@@ -196,31 +425,178 @@ class Conversation:
             'current_node': self.current_node,
         }
 
+    def iter_info(self, chunk_size=65536):
+        """ 按块输出与 get_info 相同内容的 JSON，mapping 由各 prompt 缓存的 fragment 拼接，不构造整个字典。 """
+        items = list(self.__ids.items())
+
+        chunks = [b'{"title":', codec.dumps(self.title), b',"create_time":', codec.dumps(self.create_time),
+                  b',"mapping":{']
+        size = 0
+        for i, (prompt_id, index) in enumerate(items):
+            fragment = self.__get_fragment(self.__nodes[index])
+            chunks.append(b',' + fragment if i else fragment)
+            size += len(fragment)
+
+            if size >= chunk_size:
+                yield b''.join(chunks)
+                chunks = []
+                size = 0
+
+        chunks.append(b'},"moderation_results":[],"current_node":')
+        chunks.append(codec.dumps(self.current_node))
+        chunks.append(b'}')
+
+        yield b''.join(chunks)
+
+    def __get_fragment(self, prompt):
+        fragment = prompt.fragment
+        if fragment is not None:
+            return fragment
+
+        version = prompt.version
+        info = prompt.get_info(self.get_parent_id(prompt), self.get_children_ids(prompt))
+        fragment = b''.join((codec.dumps(prompt.prompt_id), b':', codec.dumps(info)))
+
+        # 生成期间被修改的话丢弃，下次重新生成
+        prompt.fragment = fragment
+        if version != prompt.version:
+            prompt.fragment = None
+
+        return fragment
+
 
 class Conversations:
-    def __init__(self):
-        self.__data = []
+    """ 一个 token key 下的会话。
+    1. 传入 pool 时常驻内存的会话受 pool 的预算限制，被淘汰的会话由 _spill 落盘，
+       返回的 ConversationItem 留在原位保持列表顺序，再次访问时由 _restore 载入。
+    2. hold 到 release 之间（正在生成回复）的会话不会被淘汰，被淘汰后才保存的会话会重新放回内存。
+    """
+
+    def __init__(self, pool=None):
+        self.__data = OrderedDict()
+        self.__busy = {}
+        self.__lock = threading.RLock()
+        self.pool = pool
+
+    @staticmethod
+    def make_cursor(item):
+        return '{}_{}'.format(item.create_time, item.conversation_id)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        if not cursor:
+            return None
+
+        try:
+            create_time, conversation_id = cursor.split('_', 1)
+            return float(create_time), conversation_id
+        except ValueError:
+            raise ValueError('Invalid cursor: {}'.format(cursor))
+
+    def list(self, offset, limit, cursor=None):
+        cursor = self.parse_cursor(cursor)
 
-    def list(self, offset, limit):
-        return len(self.__data), self.__data[offset: limit]
+        with self.__lock:
+            items = reversed(self.__data.values())
+
+            if cursor:
+                items = dropwhile(lambda x: (x.create_time, x.conversation_id) >= cursor, items)
+                offset = 0
+
+            return len(self.__data), list(islice(items, offset, offset + limit))
 
     def clear(self):
-        self.__data = []
+        with self.__lock:
+            data, self.__data = self.__data, OrderedDict()
+
+        for conversation in data.values():
+            if isinstance(conversation, Conversation):
+                conversation.deleted = True
+
+        if self.pool:
+            self.pool.discard(self)
 
     def delete(self, conversation):
-        self.__data = [x for x in self.__data if conversation.conversation_id != x.conversation_id]
+        conversation.deleted = True
+
+        with self.__lock:
+            self.__data.pop(conversation.conversation_id, None)
+
+        if self.pool:
+            self.pool.discard(self, conversation.conversation_id)
 
     def new(self):
-        conversation = Conversation()
-        self.__data.insert(0, conversation)
+        return self.add(Conversation())
+
+    def add(self, conversation):
+        with self.__lock:
+            self.__data[conversation.conversation_id] = conversation
+
+        if self.pool:
+            self.pool.touch(self, conversation)
 
         return conversation
 
+    def save(self, conversation, end_turn=False):
+        if not end_turn or not self.pool or conversation.deleted:
+            return
+
+        with self.__lock:
+            item = self.__data.get(conversation.conversation_id)
+            if item is not conversation and (item is None or isinstance(item, ConversationItem)):
+                self.__data[conversation.conversation_id] = conversation
+
+        self.pool.touch(self, conversation, True)
+
     def get(self, conversation_id):
-        for x in self.__data:
-            if x.conversation_id == conversation_id:
-                return x
+        with self.__lock:
+            conversation = self.__data.get(conversation_id)
+            if isinstance(conversation, ConversationItem):
+                conversation = self._restore(conversation_id)
+                if conversation:
+                    self.__data[conversation_id] = conversation
+                else:
+                    del self.__data[conversation_id]
+
+                if self.pool:
+                    self.pool.restored()
+
+        if conversation and self.pool:
+            self.pool.touch(self, conversation)
+
+        return conversation
+
+    def hold(self, conversation):
+        with self.__lock:
+            self.__busy[conversation.conversation_id] = self.__busy.get(conversation.conversation_id, 0) + 1
+
+    def release(self, conversation):
+        with self.__lock:
+            count = self.__busy.pop(conversation.conversation_id, 1) - 1
+            if count:
+                self.__busy[conversation.conversation_id] = count
+
+    def is_busy(self, conversation_id):
+        return conversation_id in self.__busy
+
+    def evict(self, conversation_id):
+        with self.__lock:
+            conversation = self.__data.get(conversation_id)
+            if conversation_id in self.__busy or not isinstance(conversation, Conversation):
+                return False
+
+            item = self._spill(conversation)
+            if item:
+                self.__data[conversation_id] = item
+            else:
+                del self.__data[conversation_id]
+
+            return True
+
+    def _spill(self, conversation):
+        return None
 
+    def _restore(self, conversation_id):
         return None
 
     def guard_get(self, conversation_id):
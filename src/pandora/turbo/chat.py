@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 
-import json
 from datetime import datetime as dt
 from os import getenv
 
-from requests import Response
+from requests.structures import CaseInsensitiveDict
 
 from .base import Conversations, UserPrompt, Prompt, SystemPrompt
+from .reducer import get_reducer
+from .scheduler import get_scheduler
+from .storage import DatabaseConversations, MemoryConversations, writer, resident_pool
 from ..openai.api import ChatCompletion
-from ..openai.token import gpt_num_tokens
+from ..openai.result import Result, ReleasingIterator
 
 
 class TurboGPT:
@@ -22,21 +24,34 @@ class TurboGPT:
         'gpt-4-32k': 32768,
     }
 
-    def __init__(self, api_keys: dict, proxy=None):
+    def __init__(self, api_keys: dict, proxy=None, shared=False):
         self.api_keys = api_keys
         self.api_keys_key_list = list(api_keys)
         self.default_api_keys_key = self.api_keys_key_list[0]
 
         self.api = ChatCompletion(proxy)
         self.conversations_map = {}
+        self.storage = getenv('API_STORAGE', 'database')
+        self.count_ttl = float(getenv('DATABASE_COUNT_TTL', 60))
+        self.shared = shared
         self.system_prompt = getenv('API_SYSTEM_PROMPT', self.DEFAULT_SYSTEM_PROMPT)
+        self.reducer = get_reducer(getenv('API_CONTEXT_STRATEGY'))
+        self.resident_pool = resident_pool if resident_pool.enabled and not shared else None
+        self.scheduler = get_scheduler(getenv('API_KEY_SCHEDULER'), self.api_keys_key_list,
+                                       float(getenv('API_KEY_COOLDOWN', 20)))
 
     def __get_conversations(self, api_keys_key=None):
         if api_keys_key is None:
             api_keys_key = self.default_api_keys_key
 
         if api_keys_key not in self.conversations_map:
-            self.conversations_map[api_keys_key] = Conversations()
+            if 'memory' == self.storage:
+                conversations = MemoryConversations(api_keys_key, self.resident_pool, getenv('API_SPILL_DIR'))
+            else:
+                conversations = DatabaseConversations(api_keys_key, writer, self.count_ttl, self.shared,
+                                                      self.resident_pool)
+
+            self.conversations_map.setdefault(api_keys_key, conversations)
 
         return self.conversations_map[api_keys_key]
 
@@ -78,10 +93,17 @@ class TurboGPT:
 
         return models['models']
 
-    def list_conversations(self, offset, limit, raw=False, token=None):
+    def list_conversations(self, offset, limit, raw=False, token=None, cursor=None):
         offset = int(offset)
         limit = int(limit)
-        total, items = self.__get_conversations(token).list(offset, limit)
+
+        try:
+            total, items = self.__get_conversations(token).list(offset, limit, cursor)
+        except ValueError as e:
+            if raw:
+                return self.__out_error(str(e), 400)
+
+            raise
 
         stripped = []
         for item in items:
@@ -91,7 +113,8 @@ class TurboGPT:
                 'create_time': dt.utcfromtimestamp(item.create_time).isoformat(),
             })
 
-        result = {'items': stripped, 'total': total, 'limit': limit, 'offset': offset}
+        next_cursor = Conversations.make_cursor(items[-1]) if items and len(items) == limit else None
+        result = {'items': stripped, 'total': total, 'limit': limit, 'offset': offset, 'next_cursor': next_cursor}
 
         if raw:
             return self.__wrap_response(result)
@@ -105,7 +128,10 @@ class TurboGPT:
             except Exception as e:
                 return self.__out_error(str(e), 404)
 
-            return self.__wrap_response(conversation.get_info())
+            if raw:
+                return Result(chunks=conversation.iter_info())
+
+            return Result(conversation.get_info())
 
         resp = __shadow()
 
@@ -176,13 +202,14 @@ class TurboGPT:
             messages = conversation.get_messages_directly(message_id)
             messages.append({'role': 'user', 'content': self.TITLE_PROMPT})
 
-            status, header, generator = self.api.request(self.get_access_token(token), model, messages, False)
+            status, header, generator = self.__request(token, model, messages, False)
             last_ok, last = self.__get_completion(status, next(generator))
 
             if not last_ok:
                 return self.__out_error(last['detail'], status)
 
             conversation.set_title(last.strip('"'))
+            self.__get_conversations(token).save(conversation, True)
 
             result = {
                 'title': conversation.title
@@ -208,6 +235,7 @@ class TurboGPT:
                 return self.__out_error(str(e), 404)
 
             conversation.set_title(title)
+            self.__get_conversations(token).save(conversation, True)
 
             result = {
                 'success': True
@@ -225,70 +253,112 @@ class TurboGPT:
 
         return resp.json()['success']
 
-    def talk(self, content, model, message_id, parent_message_id, conversation_id=None, stream=True, token=None):
+    def talk(self, content, model, message_id, parent_message_id, conversation_id=None, stream=True, token=None,
+             delta=False):
         system_prompt = None
+        conversations = self.__get_conversations(token)
         if conversation_id:
-            conversation = self.__get_conversations(token).get(conversation_id)
+            conversation = conversations.get(conversation_id)
             if not conversation:
                 return self.__out_error_stream('Conversation not found', 404)
 
             parent = conversation.get_prompt(parent_message_id)
         else:
-            conversation = self.__get_conversations(token).new()
+            conversation = conversations.new()
             parent = conversation.add_prompt(Prompt(parent_message_id))
             parent = system_prompt = conversation.add_prompt(SystemPrompt(self.system_prompt, parent))
 
         conversation.add_prompt(UserPrompt(message_id, content, parent))
 
-        user_prompt, gpt_prompt, messages = conversation.get_messages(message_id, model)
+        user_prompt, gpt_prompt, prompts = conversation.get_messages(message_id, model)
+        conversations.hold(conversation)
         try:
-            status, headers, generator = self.api.request(self.get_access_token(token), model,
-                                                          self.__reduce_messages(messages, model), stream)
+            status, headers, generator = self.__request(token, model, self.__reduce_messages(prompts, model), stream)
         except Exception as e:
+            conversations.release(conversation)
+            conversations.save(conversation, True)
             return self.__out_error_stream(str(e))
 
         def __out_generator():
-            if 200 == status and system_prompt and stream:
+            if 200 == status and system_prompt and stream and not delta:
                 yield self.__out_stream(conversation, system_prompt)
                 yield self.__out_stream(conversation, user_prompt)
 
             for line in generator:
-                yield self.__map_conversation(status, conversation, gpt_prompt, line)
+                yield self.__map_conversation(status, conversation, gpt_prompt, line, delta)
 
-        return status, headers, __out_generator()
+        def __finish():
+            generator.close()
+            conversation.touch(gpt_prompt)
+            conversations.release(conversation)
+            conversations.save(conversation, True)
 
-    def goon(self, model, parent_message_id, conversation_id, stream=True, token=None):
-        return self.regenerate_reply(None, model, conversation_id, parent_message_id, None, stream, token)
+        return status, headers, ReleasingIterator(__out_generator(), __finish)
 
-    def regenerate_reply(self, prompt, model, conversation_id, message_id, parent_message_id, stream=True, token=None):
+    def goon(self, model, parent_message_id, conversation_id, stream=True, token=None, delta=False):
+        return self.regenerate_reply(None, model, conversation_id, parent_message_id, None, stream, token, delta)
+
+    def regenerate_reply(self, prompt, model, conversation_id, message_id, parent_message_id, stream=True, token=None,
+                         delta=False):
         if not conversation_id:
             return self.__out_error_stream('Miss conversation_id', 400)
 
-        conversation = self.__get_conversations(token).get(conversation_id)
+        conversations = self.__get_conversations(token)
+        conversation = conversations.get(conversation_id)
         if not conversation:
             return self.__out_error_stream('Conversation not found', 404)
 
-        user_prompt, gpt_prompt, messages = conversation.get_messages(message_id, model)
+        user_prompt, gpt_prompt, prompts = conversation.get_messages(message_id, model)
+        conversations.hold(conversation)
         try:
-            status, headers, generator = self.api.request(self.get_access_token(token), model,
-                                                          self.__reduce_messages(messages, model), stream)
+            status, headers, generator = self.__request(token, model, self.__reduce_messages(prompts, model), stream)
         except Exception as e:
+            conversations.release(conversation)
+            conversations.save(conversation, True)
             return self.__out_error_stream(str(e))
 
         def __out_generator():
             for line in generator:
-                yield self.__map_conversation(status, conversation, gpt_prompt, line)
+                yield self.__map_conversation(status, conversation, gpt_prompt, line, delta)
+
+        def __finish():
+            generator.close()
+            conversation.touch(gpt_prompt)
+            conversations.release(conversation)
+            conversations.save(conversation, True)
+
+        return status, headers, ReleasingIterator(__out_generator(), __finish)
+
+    def __request(self, token, model, messages, stream):
+        if token or not self.scheduler:
+            return self.api.request(self.get_access_token(token), model, messages, stream)
+
+        attempts = len(self.api_keys_key_list)
+        while True:
+            attempts -= 1
+            key = self.scheduler.acquire()
+            try:
+                status, headers, generator = self.api.request(self.api_keys[key], model, messages, stream)
+            except Exception:
+                self.scheduler.release(key)
+                raise
+
+            if 429 != status:
+                return status, headers, self.__release_generator(key, generator)
+
+            self.scheduler.release(key, status, headers.get('Retry-After'))
+            if attempts <= 0 or not self.scheduler.available():
+                return status, headers, generator
 
-        return status, headers, __out_generator()
+            generator.close()
 
-    def __reduce_messages(self, messages, model):
-        while gpt_num_tokens(messages) > self.MAX_TOKENS[model] - 200:
-            if len(messages) < 2:
-                raise Exception('prompt too long')
+    def __release_generator(self, key, generator):
+        return ReleasingIterator(generator, lambda: self.scheduler.release(key))
 
-            messages.pop(1)
+    def __reduce_messages(self, prompts, model):
+        prompts = self.reducer.reduce(prompts, self.MAX_TOKENS[model] - 200, model)
 
-        return messages
+        return [prompt.get_chat_message() for prompt in prompts]
 
     def __out_error(self, error, status=500):
         result = {
@@ -303,7 +373,7 @@ class TurboGPT:
         def __generator():
             yield resp.json()
 
-        return resp.status_code, resp.headers, __generator()
+        return resp.status_code, CaseInsensitiveDict({'Content-Type': resp.content_type}), __generator()
 
     @staticmethod
     def __out_stream(conversation, prompt, end=True):
@@ -314,13 +384,19 @@ class TurboGPT:
         }
 
     @staticmethod
-    def __wrap_response(data, status=200):
-        resp = Response()
-        resp.status_code = status
-        resp._content = json.dumps(data).encode('utf-8')
-        resp.headers['Content-Type'] = 'application/json'
+    def __out_stream_delta(conversation, prompt, content, end=True):
+        return {
+            'message_id': prompt.prompt_id,
+            'role': prompt.role,
+            'conversation_id': conversation.conversation_id,
+            'delta': content,
+            'end_turn': end,
+            'error': None,
+        }
 
-        return resp
+    @staticmethod
+    def __wrap_response(data, status=200):
+        return Result(data, status)
 
     @staticmethod
     def __get_completion(status, data):
@@ -339,7 +415,7 @@ class TurboGPT:
 
         return True, text
 
-    def __map_conversation(self, status, conversation, gpt_prompt, data):
+    def __map_conversation(self, status, conversation, gpt_prompt, data, delta=False):
         success, result = self.__get_completion(status, data)
         if not success:
             return result
@@ -347,4 +423,8 @@ class TurboGPT:
         choice = data['choices'][0]
         is_stop = 'stop' == choice['finish_reason']
 
-        return self.__out_stream(conversation, gpt_prompt.append_content(result), is_stop)
+        gpt_prompt.append_content(result)
+        if delta:
+            return self.__out_stream_delta(conversation, gpt_prompt, result, is_stop)
+
+        return self.__out_stream(conversation, gpt_prompt, is_stop)
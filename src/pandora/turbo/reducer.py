@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from .base import Prompt
+
+
+class ContextReducer:
+    """ 按上下文长度裁剪发送给API的消息，首条（系统prompt）总是保留。
+    每条消息的token数缓存在Prompt上，裁剪只需遍历一次。
+    """
+
+    def reduce(self, prompts, max_tokens, model='gpt-3.5-turbo'):
+        return self._trim(prompts, max_tokens, model)
+
+    @staticmethod
+    def _trim(prompts, max_tokens, model):
+        num_tokens = Prompt.count_tokens(prompts, model) + 2
+
+        start = 1
+        while num_tokens > max_tokens:
+            if len(prompts) - start + 1 < 2:
+                raise Exception('prompt too long')
+
+            num_tokens -= prompts[start].get_num_tokens(model)
+            start += 1
+
+        return prompts[:1] + prompts[start:]
+
+
+class RecentReducer(ContextReducer):
+    def __init__(self, limit):
+        self.limit = limit
+
+    def reduce(self, prompts, max_tokens, model='gpt-3.5-turbo'):
+        if len(prompts) > self.limit + 1:
+            prompts = prompts[:1] + prompts[-self.limit:]
+
+        return self._trim(prompts, max_tokens, model)
+
+
+def get_reducer(strategy):
+    name, _, arg = (strategy or 'oldest').partition(':')
+
+    if 'oldest' == name:
+        return ContextReducer()
+
+    if 'recent' == name:
+        return RecentReducer(int(arg or 10))
+
+    raise Exception('unknown context strategy: {}'.format(strategy))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+from ..openai.limiter import parse_retry_after
+
+
+class KeyScheduler:
+    """ api 模式下未指定 token key 的请求在所有 API Key 之间分配，会话仍属于默认的 token key。
+    1. least：选择进行中请求最少的 Key，数量相同时轮流选择；round_robin：按顺序轮流选择。
+    2. 上游返回 429 的 Key 进入冷却，时长取 Retry-After，没有时使用默认值，冷却中的 Key 不参与分配。
+    3. 所有 Key 都在冷却时选择最早结束冷却的 Key。
+    """
+
+    STRATEGIES = ('least', 'round_robin')
+
+    def __init__(self, keys, strategy='least', cooldown=20.0):
+        if strategy not in self.STRATEGIES:
+            raise Exception('unknown api key scheduler: {}'.format(strategy))
+
+        self.keys = list(keys)
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.reset()
+
+    def reset(self):
+        self.__lock = threading.Lock()
+        self.__next = 0
+        self.__states = {key: {'in_flight': 0, 'requests': 0, 'rate_limited': 0, 'cooldown_until': 0.0} for key in
+                         self.keys}
+
+    def acquire(self):
+        with self.__lock:
+            now = time.monotonic()
+            size = len(self.keys)
+            start, self.__next = self.__next, (self.__next + 1) % size
+
+            candidates = [x for x in self.keys if self.__states[x]['cooldown_until'] <= now]
+            if not candidates:
+                candidates = [min(self.keys, key=lambda x: self.__states[x]['cooldown_until'])]
+
+            def __order(item):
+                index = (self.keys.index(item) - start) % size
+                return (self.__states[item]['in_flight'], index) if 'least' == self.strategy else index
+
+            key = min(candidates, key=__order)
+            state = self.__states[key]
+            state['in_flight'] += 1
+            state['requests'] += 1
+
+            return key
+
+    def release(self, key, status=None, retry_after=None):
+        with self.__lock:
+            state = self.__states[key]
+            state['in_flight'] = max(0, state['in_flight'] - 1)
+
+            if 429 == status:
+                state['rate_limited'] += 1
+                state['cooldown_until'] = time.monotonic() + parse_retry_after(retry_after, self.cooldown)
+
+    def available(self):
+        now = time.monotonic()
+
+        return any(self.__states[x]['cooldown_until'] <= now for x in self.keys)
+
+    def stats(self):
+        with self.__lock:
+            now = time.monotonic()
+
+            return {
+                'strategy': self.strategy,
+                'keys': {key: {
+                    'in_flight': state['in_flight'],
+                    'requests': state['requests'],
+                    'rate_limited': state['rate_limited'],
+                    'cooldown': round(max(0.0, state['cooldown_until'] - now), 1),
+                } for key, state in self.__states.items()},
+            }
+
+
+def get_scheduler(strategy, keys, cooldown=20.0):
+    if not strategy or 'off' == strategy or len(keys) < 2:
+        return None
+
+    scheduler = KeyScheduler(keys, strategy, cooldown)
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=scheduler.reset)
+
+    return scheduler
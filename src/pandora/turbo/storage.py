@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import os
+import pickle
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha1
+from os import getenv
+
+from loguru import logger
+
+from .base import Conversations, Conversation, ConversationItem, Prompt, SystemPrompt, UserPrompt, GptPrompt
+from ..exts.config import USER_CONFIG_DIR
+from ..migrations.database import session_scope
+from ..migrations.models import Base, ConversationInfo, PromptInfo
+
+
+class ResidentPool:
+    """ api 模式下所有 token key 常驻内存的会话共用的预算，按 prompt 内容加上对象开销估算字节数，0 表示不限制。
+    1. 会话被读取、保存时移到最近使用的一端，超出总预算或单个 token key 的预算时从最久未使用的一端淘汰。
+    2. 正在访问的会话和正在生成回复的会话不会被淘汰，所以预算是软限制。
+    3. 会话的大小在新建、载入和一轮对话结束时重新计算。
+    """
+
+    PROMPT_OVERHEAD = 350
+    CONVERSATION_OVERHEAD = 1000
+
+    def __init__(self, max_bytes=0, max_bytes_per_key=0):
+        self.max_bytes = max_bytes
+        self.max_bytes_per_key = max_bytes_per_key
+        self.reset()
+
+    def reset(self):
+        self.__lru = OrderedDict()
+        self.__totals = {}
+        self.__total = 0
+        self.__lock = threading.Lock()
+        self.__evictions = 0
+        self.__restores = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 or self.max_bytes_per_key > 0
+
+    @classmethod
+    def size_of(cls, conversation):
+        return cls.CONVERSATION_OVERHEAD + sum(
+            cls.PROMPT_OVERHEAD + sys.getsizeof(prompt.content or '') + len(prompt.fragment or b'') for prompt in
+            conversation.get_prompts())
+
+    def touch(self, store, conversation, resize=False):
+        key = (store, conversation.conversation_id)
+
+        with self.__lock:
+            size = self.__lru.pop(key, None)
+            if size is None or resize:
+                self.__lru[key] = self.size_of(conversation)
+            else:
+                self.__lru[key] = size
+
+            delta = self.__lru[key] - (size or 0)
+            self.__total += delta
+            self.__totals[store] = self.__totals.get(store, 0) + delta
+
+            victims = self.__select(store, key)
+
+        for victim_store, conversation_id in victims:
+            victim_store.evict(conversation_id)
+
+    def __select(self, store, current):
+        over_total = self.__total - self.max_bytes if self.max_bytes > 0 else 0
+        over_key = self.__totals[store] - self.max_bytes_per_key if self.max_bytes_per_key > 0 else 0
+        if over_total <= 0 and over_key <= 0:
+            return []
+
+        victims = []
+        for key, size in self.__lru.items():
+            if over_total <= 0 and over_key <= 0:
+                break
+
+            if key == current or (over_total <= 0 and key[0] is not store):
+                continue
+
+            if key[0].is_busy(key[1]):
+                continue
+
+            victims.append(key)
+            over_total -= size
+            if key[0] is store:
+                over_key -= size
+
+        for key in victims:
+            self.__remove(key)
+            self.__evictions += 1
+
+        return victims
+
+    def __remove(self, key):
+        size = self.__lru.pop(key)
+        self.__total -= size
+        self.__totals[key[0]] -= size
+
+    def discard(self, store, conversation_id=None):
+        with self.__lock:
+            for key in [x for x in self.__lru if store is x[0] and conversation_id in (None, x[1])]:
+                self.__remove(key)
+
+    def restored(self):
+        with self.__lock:
+            self.__restores += 1
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'conversations': len(self.__lru),
+                'bytes': self.__total,
+                'max_bytes': self.max_bytes,
+                'max_bytes_per_key': self.max_bytes_per_key,
+                'evictions': self.__evictions,
+                'restores': self.__restores,
+            }
+
+
+class MemoryConversations(Conversations):
+    """ 只保存在内存中的会话（API_STORAGE=memory），超出预算被淘汰的会话用 pickle 写到本地目录，再次访问时读回。
+    目录按 token key 区分，启动时清空，进程退出后其中的内容不再使用。
+    """
+
+    def __init__(self, token_key, pool=None, spill_dir=None):
+        super().__init__(pool)
+        self.spill_dir = os.path.join(spill_dir or os.path.join(USER_CONFIG_DIR, 'spill'),
+                                      sha1(token_key.encode('utf-8')).hexdigest()[:16])
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def __get_path(self, conversation_id):
+        return os.path.join(self.spill_dir, '{}.pickle'.format(conversation_id))
+
+    def _spill(self, conversation):
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        with open(self.__get_path(conversation.conversation_id), 'wb') as f:
+            pickle.dump(conversation, f, pickle.HIGHEST_PROTOCOL)
+
+        return ConversationItem(conversation.conversation_id, conversation.title, conversation.create_time)
+
+    def _restore(self, conversation_id):
+        path = self.__get_path(conversation_id)
+
+        try:
+            with open(path, 'rb') as f:
+                conversation = pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+        os.remove(path)
+
+        return conversation
+
+    def delete(self, conversation):
+        super().delete(conversation)
+
+        try:
+            os.remove(self.__get_path(conversation.conversation_id))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        super().clear()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+class ConversationWriter:
+    """ 会话的延迟批量写入，流式输出过程中不访问数据库。
+    1. 一轮对话结束时会话才登记为待写入，由后台线程定时批量写入，或提前唤醒写入。
+    2. 每次只写入会话信息和有变动的 prompt，整批写入失败时逐个会话重新写入，失败的会话留待下次重试，
+       连续失败 max_retries 次的会话放弃写入并记录日志，避免一条坏数据阻塞所有会话的写入。
+    3. 写入和删除经过 lock 串行化，避免已删除的会话被再次写入。
+    4. 读取时先用 get、pending 取还没写入（包括正在写入）的会话，不需要为了读取而先写入。
+    """
+
+    def __init__(self, interval=3.0, max_retries=3):
+        self.interval = interval
+        self.max_retries = max_retries
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.RLock()
+        self.__pending = {}
+        self.__writing = {}
+        self.__pending_lock = threading.Lock()
+        self.__event = threading.Event()
+        self.__thread = None
+        self.__failures = {}
+
+    def put(self, token_key, conversation, wake=False):
+        with self.__pending_lock:
+            self.__pending[conversation.conversation_id] = (token_key, conversation)
+
+            if not self.__thread:
+                self.__thread = threading.Thread(target=self.__run, name='pandora-writer', daemon=True)
+                self.__thread.start()
+
+        if wake:
+            self.__event.set()
+
+    def get(self, token_key, conversation_id):
+        with self.__pending_lock:
+            item = self.__pending.get(conversation_id) or self.__writing.get(conversation_id)
+
+        return item[1] if item and token_key == item[0] else None
+
+    def pending(self, token_key):
+        with self.__pending_lock:
+            items = list(self.__writing.values()) + list(self.__pending.values())
+
+        return {x[1].conversation_id: x[1] for x in items if token_key == x[0]}
+
+    def discard(self, token_key, conversation_id=None):
+        with self.__pending_lock:
+            for key in list(self.__pending):
+                if token_key == self.__pending[key][0] and conversation_id in (None, key):
+                    del self.__pending[key]
+
+    def __run(self):
+        while True:
+            self.__event.wait(self.interval)
+            self.__event.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flush conversations failed.')
+
+    def flush(self, conversation_id=None):
+        with self.lock:
+            with self.__pending_lock:
+                if conversation_id is None:
+                    pending, self.__pending = self.__pending, {}
+                else:
+                    item = self.__pending.pop(conversation_id, None)
+                    pending = {conversation_id: item} if item else {}
+
+                self.__writing = pending
+
+            try:
+                self.__flush(pending)
+            finally:
+                with self.__pending_lock:
+                    self.__writing = {}
+
+    def __flush(self, pending):
+        batch = []
+        for token_key, conversation in pending.values():
+            if conversation.deleted:
+                continue
+
+            prompts = conversation.pop_dirty()
+            batch.append((token_key, conversation, prompts, self.__get_items(token_key, conversation, prompts)))
+
+        if not batch:
+            return
+
+        try:
+            with session_scope():
+                Base.merge_all([item for x in batch for item in x[3]])
+        except Exception:
+            logger.warning('Flush conversations in batch failed, retry one by one.')
+
+            for token_key, conversation, prompts, items in batch:
+                self.__write_one(token_key, conversation, prompts, items)
+        else:
+            for x in batch:
+                x[1].stored = True
+                self.__failures.pop(x[1].conversation_id, None)
+
+    def __write_one(self, token_key, conversation, prompts, items):
+        conversation_id = conversation.conversation_id
+
+        try:
+            with session_scope():
+                Base.merge_all(items)
+        except Exception:
+            failures = self.__failures.get(conversation_id, 0) + 1
+            if failures >= self.max_retries:
+                self.__failures.pop(conversation_id, None)
+                logger.exception('Flush conversation {} failed {} times, dropped.'.format(conversation_id, failures))
+                return
+
+            self.__failures[conversation_id] = failures
+            for prompt in prompts:
+                conversation.touch(prompt)
+            self.put(token_key, conversation)
+        else:
+            conversation.stored = True
+            self.__failures.pop(conversation_id, None)
+
+    @staticmethod
+    def __get_items(token_key, conversation, prompts):
+        items = [ConversationInfo(conversation_id=conversation.conversation_id, title=conversation.title,
+                                  create_time=conversation.create_time, current_node=conversation.current_node,
+                                  token_key=token_key)]
+        for prompt in prompts:
+            items.append(PromptInfo(prompt_id=prompt.prompt_id, conversation_id=conversation.conversation_id,
+                                    model=prompt.model, parent_id=conversation.get_parent_id(prompt),
+                                    role=prompt.role, content=prompt.content, create_time=prompt.create_time))
+
+        return items
+
+
+class DatabaseConversations(Conversations):
+    """ 数据库存储的会话，shared 为 True 时（多进程模式）不在进程内缓存会话，每次都从数据库读取，
+    一轮对话结束时同步写入，保证其他进程能读到最新的内容。
+    1. 会话在一轮对话结束时才交给 writer，读取时不写数据库，数据库中的内容加上 writer 中待写入的内容即为最新状态。
+    2. 新建后还没写入过的会话记录在 unsaved 中，列表时与数据库中的分页按 (create_time, conversation_id) 合并。
+    """
+
+    PROMPT_TYPES = {
+        'system': SystemPrompt,
+        'user': UserPrompt,
+        'assistant': GptPrompt,
+    }
+
+    def __init__(self, token_key, writer, count_ttl=60.0, shared=False, pool=None):
+        super().__init__(None if shared else pool)
+        self.token_key = token_key
+        self.writer = writer
+        self.count_ttl = count_ttl
+        self.shared = shared
+        self.__lock = threading.RLock()
+        self.__unsaved = {}
+        self.__total = None
+        self.__total_expires = 0
+
+    def list(self, offset, limit, cursor=None):
+        cursor = self.parse_cursor(cursor)
+        unsaved = self.__get_unsaved()
+        pending = self.writer.pending(self.token_key)
+
+        with session_scope():
+            total = self.__count(len(unsaved))
+
+            if cursor:
+                rows = ConversationInfo.get_page(0, limit, self.token_key, cursor)
+                items = rows + [x for x in unsaved if self.__sort_key(x) < cursor]
+                items = sorted(items, key=self.__sort_key, reverse=True)[:limit]
+            elif unsaved:
+                items = self.__merge_page(offset, limit, unsaved)
+            else:
+                items = ConversationInfo.get_page(offset, limit, self.token_key)
+
+            items = [ConversationItem(x.conversation_id, getattr(pending.get(x.conversation_id), 'title', x.title),
+                                      x.create_time) for x in items]
+
+        return total, items
+
+    def __merge_page(self, offset, limit, unsaved):
+        # 数据库中第 i 条的位置是 i 加上比它新的 unsaved 数，所以只需要取 [offset - len(unsaved), offset + limit)
+        start = max(0, offset - len(unsaved))
+        rows = ConversationInfo.get_page(start, offset + limit - start, self.token_key)
+
+        items = []
+        for i, row in enumerate(rows):
+            newer = sum(1 for x in unsaved if self.__sort_key(x) > self.__sort_key(row))
+            items.append((start + i + newer, row))
+
+        for i, conversation in enumerate(unsaved):
+            newer = ConversationInfo.count_newer(conversation.create_time, conversation.conversation_id,
+                                                 self.token_key)
+            items.append((newer + i, conversation))
+
+        items.sort(key=lambda x: x[0])
+
+        return [x for position, x in items if offset <= position < offset + limit]
+
+    @staticmethod
+    def __sort_key(item):
+        return item.create_time, item.conversation_id
+
+    def __get_unsaved(self):
+        with self.__lock:
+            for conversation_id in [k for k, v in self.__unsaved.items() if v.stored or v.deleted]:
+                del self.__unsaved[conversation_id]
+
+            return sorted(self.__unsaved.values(), key=self.__sort_key, reverse=True)
+
+    def __count(self, unsaved):
+        now = time.monotonic()
+        if self.__total is None or now >= self.__total_expires:
+            self.__total = ConversationInfo.count(self.token_key) + unsaved
+            self.__total_expires = now + self.count_ttl
+
+        return self.__total
+
+    def __adjust_count(self, delta):
+        total = self.__total
+        if total is not None:
+            self.__total = max(0, total + delta)
+
+    def clear(self):
+        super().clear()
+
+        with self.__lock:
+            self.__unsaved.clear()
+
+        with self.writer.lock, session_scope():
+            self.writer.discard(self.token_key)
+            ConversationInfo.clear_by_token_key(self.token_key)
+            self.__total = 0
+
+    def delete(self, conversation):
+        super().delete(conversation)
+
+        with self.writer.lock, session_scope():
+            self.writer.discard(self.token_key, conversation.conversation_id)
+            ConversationInfo.delete(conversation.conversation_id)
+            PromptInfo.delete_by_conversation_id(conversation.conversation_id)
+            self.__adjust_count(-1)
+
+    def new(self):
+        conversation = Conversation() if self.shared else super().new()
+        with self.__lock:
+            self.__unsaved[conversation.conversation_id] = conversation
+
+        self.__adjust_count(1)
+
+        return conversation
+
+    def get(self, conversation_id):
+        if self.shared:
+            return self.__get_unwritten(conversation_id) or self.__load(conversation_id)
+
+        conversation = super().get(conversation_id)
+        if conversation:
+            return conversation
+
+        with self.__lock:
+            conversation = super().get(conversation_id)
+            if conversation:
+                return conversation
+
+            # 被淘汰的会话可能还在等待写入，直接取回
+            conversation = self.__get_unwritten(conversation_id) or self.__load(conversation_id)
+            if conversation:
+                self.add(conversation)
+                if self.pool:
+                    self.pool.restored()
+
+            return conversation
+
+    def __get_unwritten(self, conversation_id):
+        conversation = self.writer.get(self.token_key, conversation_id)
+        if not conversation:
+            with self.__lock:
+                conversation = self.__unsaved.get(conversation_id)
+
+        return None if not conversation or conversation.deleted else conversation
+
+    def __load(self, conversation_id):
+        with session_scope():
+            info = ConversationInfo.get(conversation_id)
+            if not info or self.token_key != info.token_key:
+                return None
+
+            prompts = []
+            for row in PromptInfo.list_by_conversation_id(conversation_id):
+                prompt_type = self.PROMPT_TYPES.get(row.role, Prompt)
+                prompts.append(prompt_type.restore(row.prompt_id, row.parent_id, row.role, row.content,
+                                                   row.create_time, row.model))
+
+            return Conversation.restore(info.conversation_id, info.title, info.create_time, info.current_node, prompts)
+
+    def save(self, conversation, end_turn=False):
+        super().save(conversation, end_turn)
+        if not end_turn:
+            return
+
+        self.writer.put(self.token_key, conversation, True)
+
+        if self.shared:
+            self.writer.flush(conversation.conversation_id)
+
+
+writer = ConversationWriter(float(getenv('API_FLUSH_INTERVAL', 3)))
+atexit.register(writer.flush)
+
+resident_pool = ResidentPool(int(float(getenv('API_MEMORY_LIMIT', 0)) * 1024 * 1024),
+                             int(float(getenv('API_MEMORY_LIMIT_PER_KEY', 0)) * 1024 * 1024))
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=writer.reset)
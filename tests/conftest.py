@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+from os.path import abspath, dirname, join
+
+import pytest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'src'))
+
+# 数据库相关的模块在导入时读取配置，必须在导入 pandora 之前指定
+os.environ.setdefault('USER_CONFIG_DIR', tempfile.mkdtemp(prefix='pandora-tests-'))
+
+
+@pytest.fixture(scope='session')
+def database():
+    from pandora.migrations.migrate import do_migrate
+
+    do_migrate()
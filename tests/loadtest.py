@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+""" 对比 waitress 与 asgi 两种运行方式的并发流式对话能力。
+
+上游是本地的假 ChatGPT 服务，每个对话按固定间隔输出若干事件，pandora 以子进程方式运行，
+客户端同时发起指定数量的 /api/conversation/talk 请求，统计首个事件的等待时间和全部完成的耗时。
+
+    python tests/loadtest.py --streams 500 --events 20 --interval 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from os.path import join, abspath, dirname
+
+SRC_DIR = join(dirname(dirname(abspath(__file__))), 'src')
+
+
+async def __handle_upstream(reader, writer, events, interval):
+    try:
+        headers = await reader.readuntil(b'\r\n\r\n')
+        length = 0
+        for line in headers.split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            if b'content-length' == name.strip().lower():
+                length = int(value)
+        await reader.readexactly(length)
+
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n')
+
+        message_id = str(uuid.uuid4())
+        for i in range(events):
+            await asyncio.sleep(interval)
+            data = {
+                'message': {
+                    'id': message_id,
+                    'author': {'role': 'assistant'},
+                    'content': {'content_type': 'text', 'parts': ['x' * (i + 1)]},
+                    'end_turn': i + 1 == events,
+                },
+                'conversation_id': message_id,
+                'error': None,
+            }
+            writer.write(b'data: ' + json.dumps(data).encode() + b'\n\n')
+            await writer.drain()
+
+        writer.write(b'data: [DONE]\n\n')
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def serve_upstream(port, events, interval):
+    loop = asyncio.new_event_loop()
+    server = asyncio.start_server(lambda r, w: __handle_upstream(r, w, events, interval), '127.0.0.1', port,
+                                  backlog=4096)
+    loop.run_until_complete(server)
+    loop.run_forever()
+
+
+def serve_pandora(port, upstream_port, engine, threads):
+    os.environ['CHATGPT_API_PREFIX'] = 'http://127.0.0.1:{}'.format(upstream_port)
+    sys.path.insert(0, SRC_DIR)
+
+    from pandora.bots.server import ChatBot
+    from pandora.openai.api import ChatGPT
+
+    ChatBot(ChatGPT({'default': 'fake-access-token'})).run('127.0.0.1:{}'.format(port), threads, engine)
+
+
+async def __talk(client, url):
+    payload = {
+        'prompt': 'hello',
+        'model': 'text-davinci-002-render-sha',
+        'message_id': str(uuid.uuid4()),
+        'parent_message_id': str(uuid.uuid4()),
+        'stream': True,
+    }
+
+    start = time.monotonic()
+    first = None
+    frames = 0
+
+    async with client.stream('POST', url, json=payload) as resp:
+        if 200 != resp.status_code:
+            raise Exception('status {}'.format(resp.status_code))
+
+        async for line in resp.aiter_lines():
+            if not line.startswith('data: '):
+                continue
+
+            if first is None:
+                first = time.monotonic() - start
+            frames += 1
+
+    return first, time.monotonic() - start, frames
+
+
+async def __run_clients(port, streams, timeout):
+    import httpx
+
+    url = 'http://127.0.0.1:{}/api/conversation/talk'.format(port)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        start = time.monotonic()
+        results = await asyncio.gather(*[__talk(client, url) for _ in range(streams)], return_exceptions=True)
+
+        return results, time.monotonic() - start
+
+
+def __percentile(values, percent):
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def __wait_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise Exception('port {} is not ready'.format(port))
+
+
+def __free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def __spawn(*args):
+    return subprocess.Popen([sys.executable, abspath(__file__)] + [str(x) for x in args], stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+
+def bench(engine, args, upstream_port):
+    port = __free_port()
+    server = __spawn('--serve', engine, '--port', port, '--upstream_port', upstream_port, '--threads', args.threads)
+
+    try:
+        __wait_port(port)
+
+        loop = asyncio.new_event_loop()
+        results, elapsed = loop.run_until_complete(__run_clients(port, args.streams, args.timeout))
+        loop.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    finished = [x for x in results if not isinstance(x, BaseException)]
+    firsts = [x[0] for x in finished if x[0] is not None]
+    totals = [x[1] for x in finished]
+
+    return {
+        'engine': engine,
+        'streams': args.streams,
+        'ok': len(finished),
+        'errors': len(results) - len(finished),
+        'first_p50': __percentile(firsts, 50),
+        'first_p95': __percentile(firsts, 95),
+        'total_p95': __percentile(totals, 95),
+        'elapsed': elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engines', default='waitress,asgi', help='Engines to compare, default: waitress,asgi')
+    parser.add_argument('--streams', type=int, default=200, help='Concurrent streams, default: 200')
+    parser.add_argument('--events', type=int, default=20, help='Events per stream, default: 20')
+    parser.add_argument('--interval', type=float, default=0.1, help='Seconds between events, default: 0.1')
+    parser.add_argument('--threads', type=int, default=8, help='Server threads, default: 8')
+    parser.add_argument('--timeout', type=float, default=600, help='Client timeout in seconds, default: 600')
+    parser.add_argument('--serve', choices=['waitress', 'asgi', 'upstream'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--upstream_port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if 'upstream' == args.serve:
+        return serve_upstream(args.port, args.events, args.interval)
+
+    if args.serve:
+        return serve_pandora(args.port, args.upstream_port, args.serve, args.threads)
+
+    upstream_port = __free_port()
+    upstream = __spawn('--serve', 'upstream', '--port', upstream_port, '--events', args.events, '--interval',
+                       args.interval)
+
+    try:
+        __wait_port(upstream_port)
+
+        print('{:<10}{:>8}{:>8}{:>8}{:>12}{:>12}{:>12}{:>10}'.format(
+            'engine', 'streams', 'ok', 'errors', 'first p50', 'first p95', 'total p95', 'elapsed'))
+
+        for engine in args.engines.split(','):
+            report = bench(engine, args, upstream_port)
+            print('{engine:<10}{streams:>8}{ok:>8}{errors:>8}{first_p50:>12.3f}{first_p95:>12.3f}'
+                  '{total_p95:>12.3f}{elapsed:>10.2f}'.format(**report))
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+
+from pandora.bots.asgi import WsgiBridge
+from pandora.openai import codec
+from pandora.openai.api import API
+from pandora.openai.stream import engine, EventStream
+
+
+def __scope(path):
+    return {
+        'type': 'http',
+        'method': 'POST',
+        'path': path,
+        'query_string': b'',
+        'http_version': '1.1',
+        'headers': [],
+    }
+
+
+def test_sends_ready_events_without_blocking_on_partial_line():
+    gate = threading.Event()
+
+    async def __slow():
+        yield b'data: {"a":1}\n\ndata: {"a":2}\n\ndata: {"a"'
+        while not gate.is_set():
+            await asyncio.sleep(0.01)
+        yield b':3}\n\n'
+
+    async def __fast():
+        yield b'data: {"b":1}\n\n'
+
+    upstreams = {'/slow': __slow, '/fast': __fast}
+
+    def __app(environ, start_response):
+        channel = engine.open(upstreams[environ['PATH_INFO']]())
+        start_response('200 OK', [('Content-Type', 'text/event-stream')])
+
+        return API.wrap_stream_out(EventStream(channel), 200)
+
+    bridge = WsgiBridge(__app, threads=1)
+
+    async def __request(path, messages):
+        requested = []
+
+        async def __receive():
+            if not requested:
+                requested.append(True)
+                return {'type': 'http.request', 'body': b''}
+
+            await asyncio.sleep(60)
+
+        async def __send(message):
+            messages.append(message)
+
+        await bridge(__scope(path), __receive, __send)
+
+    def __body(messages):
+        return b''.join(x.get('body', b'') for x in messages)
+
+    async def __main():
+        slow_messages, fast_messages = [], []
+        slow = asyncio.ensure_future(__request('/slow', slow_messages))
+
+        for _ in range(200):
+            if b'{"a":2}' in __body(slow_messages):
+                break
+            await asyncio.sleep(0.01)
+
+        # 两个完整事件在同一个字节块中到达，应该一起发出，而不是等到下一个字节块
+        assert codec.frame({'a': 1}) + codec.frame({'a': 2}) == __body(slow_messages)
+
+        # 只有一个线程，半行数据不能让读取占住线程
+        await asyncio.wait_for(__request('/fast', fast_messages), 2)
+        assert codec.frame({'b': 1}) + codec.DONE_FRAME == __body(fast_messages)
+
+        gate.set()
+        await asyncio.wait_for(slow, 2)
+
+        assert codec.frame({'a': 1}) + codec.frame({'a': 2}) + codec.frame({'a': 3}) + codec.DONE_FRAME == __body(
+            slow_messages)
+
+    asyncio.get_event_loop().run_until_complete(__main())
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import random
+import time
+
+from pandora.turbo.base import Conversations
+
+
+def __build(size):
+    conversations = Conversations()
+    ids = [conversations.new().conversation_id for _ in range(size)]
+
+    return conversations, ids
+
+
+def __per_op(func, args):
+    start = time.perf_counter()
+    for arg in args:
+        func(arg)
+
+    return (time.perf_counter() - start) / len(args)
+
+
+def __measure(size):
+    conversations, ids = __build(size)
+    sample = random.Random(size).sample(ids, 1000)
+    cursor = Conversations.make_cursor(conversations.list(0, 20)[1][-1])
+
+    return {
+        'get': __per_op(conversations.get, sample),
+        'list': __per_op(lambda _: conversations.list(0, 20), range(1000)),
+        'cursor': __per_op(lambda _: conversations.list(0, 20, cursor), range(1000)),
+        'delete': __per_op(lambda x: conversations.delete(conversations.get(x)), sample),
+    }
+
+
+def test_operations_do_not_scale_with_conversation_count():
+    """ 100k 个会话时 get、首页列表、游标翻页、删除的耗时与 1k 个会话时处于同一量级，线性扫描会慢约 100 倍。 """
+    small = min((__measure(1000) for _ in range(3)), key=lambda x: sum(x.values()))
+    large = __measure(100000)
+
+    for name in small:
+        print('{:>6}: 1k {:.2f}us, 100k {:.2f}us'.format(name, small[name] * 1e6, large[name] * 1e6))
+        assert large[name] < small[name] * 10 + 5e-6, name
+
+
+def test_offset_and_cursor_pages_match():
+    conversations, ids = __build(100)
+    newest_first = list(reversed(ids))
+
+    total, first = conversations.list(0, 20)
+    _, second = conversations.list(20, 20)
+    _, by_cursor = conversations.list(999, 20, Conversations.make_cursor(first[-1]))
+
+    assert 100 == total
+    assert newest_first[:20] == [x.conversation_id for x in first]
+    assert newest_first[20:40] == [x.conversation_id for x in second]
+    assert second == by_cursor
+
+    conversations.delete(conversations.get(newest_first[0]))
+    assert newest_first[1] == conversations.list(0, 1)[1][0].conversation_id
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from sqlalchemy import text
+
+from pandora.migrations.database import engine, session_scope
+from pandora.turbo.base import Prompt, UserPrompt
+from pandora.turbo.storage import ConversationWriter, DatabaseConversations
+
+THREADS = 8
+CONVERSATIONS = 40
+
+
+def test_sqlite_uses_wal(database):
+    with engine.connect() as connection:
+        assert 'wal' == connection.execute(text('PRAGMA journal_mode')).scalar().lower()
+
+
+def test_concurrent_save_list_get(database):
+    barrier = threading.Barrier(THREADS)
+    errors = []
+    created = {}
+
+    def __worker(index):
+        token_key = 'stress-{}'.format(index)
+        writer = ConversationWriter(interval=3600)
+        store = DatabaseConversations(token_key, writer)
+        reader = DatabaseConversations(token_key, writer, shared=True)
+        ids = created[token_key] = []
+
+        try:
+            barrier.wait()
+
+            for i in range(CONVERSATIONS):
+                conversation = store.new()
+                root = conversation.add_prompt(Prompt())
+                conversation.add_prompt(UserPrompt(None, 'hello {} {}'.format(index, i), root))
+                store.save(conversation, True)
+                ids.append(conversation.conversation_id)
+
+                writer.flush()
+                reader.list(0, 20)
+                assert reader.get(ids[i // 2]) is not None
+
+            # 写入失败的会话会留在 pending 中等待重试，这里要求全部一次写入成功
+            assert {} == writer.pending(token_key)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=__worker, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [] == errors
+
+    for token_key, ids in created.items():
+        store = DatabaseConversations(token_key, ConversationWriter(interval=3600))
+        total, items = store.list(0, CONVERSATIONS)
+
+        assert CONVERSATIONS == total
+        assert set(ids) == {x.conversation_id for x in items}
+        assert all(store.get(x) is not None for x in ids)
+
+        store.clear()
+
+    with session_scope() as session:
+        sql = text("SELECT COUNT(*) FROM conversation_info WHERE token_key LIKE 'stress-%'")
+        assert 0 == session.execute(sql).scalar()
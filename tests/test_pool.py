@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from pandora.openai.pool import ClientPool
+
+
+class HangingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    release = threading.Event()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.write(b'5\r\nhello\r\n')
+        self.wfile.flush()
+        self.release.wait(5)
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), HangingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    HangingHandler.release.clear()
+
+    yield 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+    HangingHandler.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def test_streams_are_not_bounded_by_default():
+    assert ClientPool().limits.max_connections is None
+    assert 50 == ClientPool(max_streams=50).limits.max_connections
+
+
+def test_more_streams_than_request_connections(server):
+    async def __main():
+        client = ClientPool(max_connections=2).get_async_client(None, False)
+        responses = [await client.send(client.build_request('GET', server), stream=True) for _ in range(5)]
+
+        try:
+            assert all(200 == x.status_code for x in responses)
+        finally:
+            HangingHandler.release.set()
+            for resp in responses:
+                await resp.aclose()
+
+            await client.aclose()
+
+    asyncio.run(__main())
+
+
+def test_bounded_streams_fail_fast(server):
+    async def __main():
+        client = ClientPool(max_streams=1).get_async_client(None, False)
+        timeout = httpx.Timeout(600, pool=0.2)
+        first = await client.send(client.build_request('GET', server, timeout=timeout), stream=True)
+
+        try:
+            with pytest.raises(httpx.PoolTimeout):
+                await client.send(client.build_request('GET', server, timeout=timeout), stream=True)
+        finally:
+            HangingHandler.release.set()
+            await first.aclose()
+            await client.aclose()
+
+    asyncio.run(__main())
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import random
+import threading
+import tracemalloc
+import uuid
+from datetime import datetime as dt
+
+from pandora.openai import codec
+from pandora.turbo.base import Conversation, Prompt, SystemPrompt, UserPrompt, GptPrompt
+
+PROMPT_TYPES = {'system': SystemPrompt, 'user': UserPrompt, 'assistant': GptPrompt}
+
+
+class LegacyPrompt:
+    """ 改为 __slots__ 和数组下标之前的表示方式：普通对象，记录父节点 id 和子节点 id 列表，其余字段与 Prompt 相同。 """
+
+    def __init__(self, role, content, parent=None):
+        self.prompt_id = str(uuid.uuid4())
+        self.parent_id = parent.prompt_id if parent else None
+        self.children = []
+        self.role = role
+        self.content = content
+        self.create_time = dt.now().timestamp()
+        self.model = None
+        self.num_tokens = None
+        self.chat_message = None
+        self.fragment = None
+        self.version = 0
+
+        if parent:
+            parent.children.append(self.prompt_id)
+
+
+def __build(size):
+    conversation = Conversation()
+    parent = conversation.add_prompt(Prompt())
+    for i in range(size // 2):
+        parent = conversation.add_prompt(UserPrompt(None, 'question', parent))
+        parent = conversation.add_prompt(GptPrompt(parent, 'gpt-3.5-turbo').append_content('answer'))
+
+    return conversation
+
+
+def __build_legacy(size):
+    prompts = {}
+    parent = None
+    for i in range(size // 2):
+        for role, content in (('user', 'question'), ('assistant', 'answer')):
+            parent = LegacyPrompt(role, content, parent)
+            prompts[parent.prompt_id] = parent
+
+    return prompts
+
+
+def __bytes_per_prompt(build, size):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        built = build(size)
+        if isinstance(built, Conversation):
+            built.pop_dirty()
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    del built
+
+    return used / size
+
+
+def test_memory_per_prompt():
+    """ 每条消息占用的内存不超过原来的表示方式（包括会话中的数组和路径缓存），用 pytest -s 可以看到具体数值。 """
+    legacy = __bytes_per_prompt(__build_legacy, 20000)
+    compact = __bytes_per_prompt(__build, 20000)
+
+    print('\nbytes per prompt: legacy {:.0f}, compact {:.0f}'.format(legacy, compact))
+
+    assert compact < legacy
+
+
+def __branchy():
+    conversation = Conversation()
+    root = conversation.add_prompt(Prompt())
+    system = conversation.add_prompt(SystemPrompt('system', root))
+
+    user = conversation.add_prompt(UserPrompt(None, 'first', system))
+    for i in range(3):
+        conversation.add_prompt(GptPrompt(user, 'gpt-3.5-turbo').append_content('answer {}'.format(i)))
+
+    edited = conversation.add_prompt(UserPrompt(None, 'edited', system))
+    gpt = conversation.add_prompt(GptPrompt(edited, 'gpt-3.5-turbo').append_content('reply'))
+    user = conversation.add_prompt(UserPrompt(None, 'next', gpt))
+    conversation.add_prompt(GptPrompt(user, 'gpt-3.5-turbo').append_content('done'))
+
+    return conversation
+
+
+def __to_rows(conversation):
+    return [(x.prompt_id, conversation.get_parent_id(x), x.role, x.content, x.create_time, x.model)
+            for x in conversation.get_prompts()]
+
+
+def test_restore_keeps_mapping_order():
+    conversation = __branchy()
+    info = conversation.get_info()
+
+    rows = __to_rows(conversation)
+    random.Random(0).shuffle(rows)
+
+    prompts = [PROMPT_TYPES.get(row[2], Prompt).restore(*row) for row in rows]
+    restored = Conversation.restore(conversation.conversation_id, conversation.title, conversation.create_time,
+                                    conversation.current_node, prompts)
+
+    assert info == restored.get_info()
+    assert list(info['mapping']) == list(restored.get_info()['mapping'])
+    assert b''.join(conversation.iter_info()) == b''.join(restored.iter_info())
+
+
+def test_pickle_round_trip():
+    conversation = __branchy()
+
+    restored = pickle.loads(pickle.dumps(conversation, pickle.HIGHEST_PROTOCOL))
+
+    assert conversation.get_info() == restored.get_info()
+    restored.touch(restored.get_prompt(conversation.current_node).append_content(' more'))
+    assert 'done more' == restored.get_prompt(conversation.current_node).content
+
+
+def test_appends_are_not_lost():
+    prompts = [GptPrompt(None, 'gpt-3.5-turbo') for _ in range(4)]
+
+    def __append(prompt):
+        for _ in range(2000):
+            prompt.append_content('x')
+            prompt.content
+
+    threads = [threading.Thread(target=__append, args=(prompt,)) for prompt in prompts for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(4000 == len(prompt.content) for prompt in prompts)
+
+
+def __info(conversation):
+    return codec.loads(b''.join(conversation.iter_info(chunk_size=64)))
+
+
+def test_fragments_follow_content_title_and_children():
+    conversation = __branchy()
+    assert conversation.get_info() == __info(conversation)
+
+    gpt = conversation.get_prompt(conversation.current_node)
+    gpt.append_content(' and more')
+    conversation.set_title('renamed')
+    user = conversation.add_prompt(UserPrompt(None, 'again', gpt))
+
+    info = __info(conversation)
+    assert 'renamed' == info['title']
+    assert ['done and more'] == info['mapping'][gpt.prompt_id]['message']['content']['parts']
+    assert [user.prompt_id] == info['mapping'][gpt.prompt_id]['children']
+    assert conversation.get_info() == info
+
+
+def test_fragment_changed_while_serializing_is_dropped(monkeypatch):
+    conversation = __branchy()
+    gpt = conversation.get_prompt(conversation.current_node)
+    get_info = GptPrompt.get_info
+
+    def __get_info(prompt, parent_id, children):
+        info = get_info(prompt, parent_id, children)
+        if prompt is gpt:
+            gpt.append_content(' streaming')
+
+        return info
+
+    monkeypatch.setattr(GptPrompt, 'get_info', __get_info)
+    stale = __info(conversation)
+    monkeypatch.undo()
+
+    assert ['done'] == stale['mapping'][gpt.prompt_id]['message']['content']['parts']
+    assert gpt.fragment is None
+    assert ['done streaming'] == __info(conversation)['mapping'][gpt.prompt_id]['message']['content']['parts']
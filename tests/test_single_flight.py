@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from pandora.openai.api import ChatGPT
+from pandora.openai.cache import cache, single_flight, SingleFlight
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = 0.5
+    hits = 0
+    tokens = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with StubHandler.lock:
+            StubHandler.hits += 1
+            StubHandler.tokens.append(self.headers['Authorization'])
+
+        time.sleep(self.delay)
+
+        body = json.dumps({'title': 'stub', 'path': self.path}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def chatgpt(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setenv('CHATGPT_API_PREFIX', 'http://127.0.0.1:{}'.format(server.server_address[1]))
+    monkeypatch.setenv('PANDORA_CACHE_TTL', '0')
+    StubHandler.hits = 0
+    StubHandler.tokens = []
+    cache.reset()
+    single_flight.reset()
+
+    yield ChatGPT({'default': 'token', 'other': 'other-token'})
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_concurrent_gets_share_one_upstream_request(chatgpt):
+    barrier = threading.Barrier(100)
+    results = []
+
+    def __get():
+        barrier.wait()
+        results.append(chatgpt.get_conversation('c1'))
+
+    threads = [threading.Thread(target=__get) for _ in range(100)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 1 == StubHandler.hits
+    assert 100 == len(results)
+    assert all({'title': 'stub', 'path': '/api/conversation/c1'} == x for x in results)
+    assert 99 == single_flight.stats()['shared']
+
+
+def test_different_urls_are_not_merged(chatgpt):
+    threads = [threading.Thread(target=chatgpt.get_conversation, args=('c{}'.format(i),)) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 5 == StubHandler.hits
+
+
+def test_different_tokens_are_not_merged(chatgpt):
+    barrier = threading.Barrier(20)
+
+    def __get(token):
+        barrier.wait()
+        chatgpt.get_conversation('c1', token=token)
+
+    threads = [threading.Thread(target=__get, args=(('default', 'other')[i % 2],)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 2 == StubHandler.hits
+    assert ['Bearer other-token', 'Bearer token'] == sorted(StubHandler.tokens)
+    assert 18 == single_flight.stats()['shared']
+
+
+def test_followers_receive_leader_error():
+    flight = SingleFlight()
+    started = threading.Event()
+    errors = []
+
+    def __fail():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError('upstream failed')
+
+    def __call():
+        try:
+            flight.do('key', __fail)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=__call)
+    leader.start()
+    started.wait()
+
+    followers = [threading.Thread(target=__call) for _ in range(10)]
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert 11 == len(errors)
+    assert {'in_flight': 0, 'requests': 1, 'shared': 10} == flight.stats()
+
+
+def test_relayed_response_is_closed_before_first_read(chatgpt, monkeypatch):
+    closed = []
+    close = requests.Response.close
+
+    def __close(resp):
+        closed.append(resp)
+        close(resp)
+
+    monkeypatch.setattr(requests.Response, 'close', __close)
+    chatgpt.cache_max_body = 0
+
+    body = chatgpt.get_conversation('c1', raw=True).get_body()
+    assert not closed
+
+    body.close()
+    assert 1 == len(closed)
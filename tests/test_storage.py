@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from pandora.turbo.base import Conversations, Prompt, SystemPrompt, UserPrompt, GptPrompt
+from pandora.turbo.storage import ConversationWriter, DatabaseConversations
+
+
+@pytest.fixture
+def store(database, request):
+    writer = ConversationWriter(interval=3600)
+    conversations = DatabaseConversations('test-{}'.format(request.node.name), writer)
+
+    yield conversations
+
+    conversations.clear()
+
+
+def __talk(conversations, content):
+    conversation = conversations.new()
+    parent = conversation.add_prompt(Prompt())
+    parent = conversation.add_prompt(SystemPrompt('system', parent))
+    user = conversation.add_prompt(UserPrompt(None, content, parent))
+    gpt = conversation.add_prompt(GptPrompt(user, 'gpt-3.5-turbo'))
+
+    return conversation, gpt
+
+
+def __ids(conversations, offset, limit, cursor=None):
+    return [x.conversation_id for x in conversations.list(offset, limit, cursor)[1]]
+
+
+def test_reads_do_not_flush(store, monkeypatch):
+    stored = [__talk(store, 'stored {}'.format(i))[0] for i in range(5)]
+    for conversation in stored:
+        store.save(conversation, True)
+    store.writer.flush()
+
+    unsaved = [__talk(store, 'unsaved {}'.format(i))[0] for i in range(3)]
+    stored[0].set_title('renamed')
+    store.save(stored[0], True)
+
+    def __flush(*args):
+        raise AssertionError('reads must not flush')
+
+    monkeypatch.setattr(store.writer, 'flush', __flush)
+
+    newest_first = [x.conversation_id for x in reversed(stored + unsaved)]
+    total, items = store.list(0, 20)
+
+    assert 8 == total
+    assert newest_first == [x.conversation_id for x in items]
+    assert 'renamed' == items[-1].title
+    assert unsaved[0] is store.get(unsaved[0].conversation_id)
+
+
+def test_merged_pages_match_flushed_order(store):
+    for i in range(6):
+        conversation, _ = __talk(store, str(i))
+        if i % 2:
+            store.save(conversation, True)
+    store.writer.flush()
+    for i in range(6):
+        __talk(store, 'new {}'.format(i))
+
+    before = [__ids(store, offset, 3) for offset in range(0, 12, 3)]
+    cursor_pages = []
+    items = store.list(0, 5)[1]
+    while items:
+        cursor_pages.append([x.conversation_id for x in items])
+        items = store.list(0, 5, Conversations.make_cursor(items[-1]))[1]
+
+    for conversation_id in sum(before, []):
+        store.save(store.get(conversation_id), True)
+    store.writer.flush()
+
+    assert before == [__ids(store, offset, 3) for offset in range(0, 12, 3)]
+    assert sum(before, []) == sum(cursor_pages, [])
+
+
+def test_only_finished_turns_are_written(store):
+    conversation, gpt = __talk(store, 'hello')
+    store.hold(conversation)
+    gpt.append_content('half')
+    store.writer.flush()
+
+    other = DatabaseConversations(store.token_key, store.writer, shared=True)
+    assert other.list(0, 10)[1] == []
+
+    gpt.append_content(' done')
+    conversation.touch(gpt)
+    store.release(conversation)
+    store.save(conversation, True)
+
+    assert other.get(conversation.conversation_id) is conversation
+    store.writer.flush()
+
+    loaded = DatabaseConversations(store.token_key, store.writer).get(conversation.conversation_id)
+    assert 'half done' == loaded.get_prompt(gpt.prompt_id).content
+
+
+def test_create_time_keeps_sub_second_precision(store):
+    conversations = [__talk(store, str(i))[0] for i in range(3)]
+    for conversation in conversations:
+        store.save(conversation, True)
+    store.writer.flush()
+
+    loaded = DatabaseConversations(store.token_key, store.writer)
+    items = loaded.list(0, 10)[1]
+
+    assert [x.conversation_id for x in reversed(conversations)] == [x.conversation_id for x in items]
+    assert [x.create_time for x in reversed(conversations)] == [x.create_time for x in items]
+
+    conversation = loaded.get(conversations[0].conversation_id)
+    assert conversations[0].get_info() == conversation.get_info()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from pandora.openai.stream import StreamEngine, EventStream
+
+
+@pytest.fixture
+def engine():
+    engine = StreamEngine()
+
+    yield engine
+
+    engine.watch(None)
+
+
+def test_disconnected_client_cancels_upstream(engine):
+    client = {'gone': False}
+    cancelled = threading.Event()
+
+    async def __upstream():
+        try:
+            yield b'data: {"a":1}\n\n'
+            await asyncio.sleep(60)
+            yield b'data: {"a":2}\n\n'
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    engine.watch(lambda: client['gone'])
+    channel = engine.open(__upstream())
+    chunks = EventStream(channel).chunks()
+
+    assert b'data: {"a":1}\n\n' == next(chunks)
+
+    client['gone'] = True
+    start = time.monotonic()
+
+    with pytest.raises(StopIteration):
+        next(chunks)
+
+    with pytest.raises(concurrent.futures.CancelledError):
+        channel.future.result(1)
+
+    assert time.monotonic() - start < 0.5
+    assert channel.future.cancelled()
+    assert cancelled.wait(1)
+
+
+def test_connected_client_reads_to_the_end(engine):
+    async def __upstream():
+        for i in range(3):
+            await asyncio.sleep(0.1)
+            yield str(i).encode()
+
+    engine.watch(lambda: False)
+    channel = engine.open(__upstream())
+
+    assert [b'0', b'1', b'2'] == list(EventStream(channel).chunks())
+    assert not channel.future.cancelled()
+
+
+def test_ready_only_counts_complete_events(engine):
+    gate = threading.Event()
+
+    async def __upstream():
+        yield b'data: {"a":1}\n\ndata: {"a":2}\n\ndata: {"a"'
+        while not gate.is_set():
+            await asyncio.sleep(0.01)
+        yield b':3}\n\n'
+
+    channel = engine.open(__upstream())
+    stream = EventStream(channel)
+
+    deadline = time.monotonic() + 1
+    while not stream.ready() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert channel.ready()
+    assert [{'a': 1}, {'a': 2}] == [next(stream), next(stream)]
+
+    time.sleep(0.1)
+    assert not channel.ready()
+
+    gate.set()
+    assert {'a': 3} == next(stream)
+
+    with pytest.raises(StopIteration):
+        next(stream)